@@ -11,25 +11,133 @@ currently loaded onto it.
 
 import logging
 import os
+import re
 import os.path
 import sys
 import time
 import subprocess
+import threading
 
 from collections import namedtuple
 
 def assert_in(needle, haystack):
     assert needle in haystack, "%r not in %r" % (needle, haystack)
 
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def set(self, **attrs):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.attrs["error"] = "%s: %s" % (exc_type.__name__, exc_value)
+        self.tracer.record(self.name, self.start, time.time() - self.start, self.attrs)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+class Tracer(object):
+    """Collects timing spans and writes them out at exit.
+
+    Spans are only recorded after enable() is called; until then span()
+    returns a shared do-nothing object so the instrumentation costs next to
+    nothing. The output is either JSON lines (one span per line) or the
+    Chrome trace-event format (load it in chrome://tracing or Perfetto).
+    """
+
+    FORMATS = ["jsonl", "chrome"]
+
+    def __init__(self):
+        self.events = None
+        self.filename = None
+        self.format = None
+        self.lock = threading.Lock()
+
+    def enable(self, filename, format=None):
+        if format is None:
+            format = ["jsonl", "chrome"][filename.endswith(".json")]
+        assert_in(format, self.FORMATS)
+
+        if self.events is None:
+            import atexit
+            atexit.register(self.write)
+        self.events = []
+        self.filename = filename
+        self.format = format
+
+    def span(self, name, **attrs):
+        """Time a block of code: with TRACE.span("name", attr=value) as span:"""
+        if self.events is None:
+            return _NULL_SPAN
+        return _Span(self, name, attrs)
+
+    def record(self, name, start, duration, attrs):
+        with self.lock:
+            self.events.append((name, start, duration, threading.current_thread().ident, attrs))
+
+    def write(self):
+        import json
+
+        if not self.events:
+            return
+        with self.lock:
+            events, self.events = self.events, []
+
+        # JSON lines are appended so many runs can be collected in one file.
+        with open(self.filename, ["w", "a"][self.format == "jsonl"]) as f:
+            if self.format == "jsonl":
+                for name, start, duration, tid, attrs in events:
+                    f.write(json.dumps({
+                        "name": name, "start": start, "duration": duration,
+                        "pid": os.getpid(), "tid": tid, "args": attrs}) + "\n")
+            else:
+                json.dump({"traceEvents": [{
+                    "name": name, "ph": "X", "ts": start * 1e6, "dur": duration * 1e6,
+                    "pid": os.getpid(), "tid": tid, "args": attrs}
+                    for name, start, duration, tid, attrs in events]}, f)
+
+TRACE = Tracer()
+if os.environ.get("HDMI2USB_TRACE"):
+    TRACE.enable(os.environ["HDMI2USB_TRACE"], os.environ.get("HDMI2USB_TRACE_FORMAT"))
+
+
+DEV_ROOT = '/dev/bus/usb'
+SYS_ROOT = '/sys/bus/usb/devices'
+# Output of lsusb to use rather than running it (when replaying a capture).
+LSUSB_FILE = None
+
+def host_root(sys_root=None):
+    """Work out the root directory from the /sys/bus/usb/devices path."""
+    sys_root = (sys_root or SYS_ROOT).rstrip("/")
+    suffix = "/sys/bus/usb/devices"
+    assert sys_root.endswith(suffix), sys_root
+    return sys_root[:-len(suffix)] or "/"
+
+
 PathBase = namedtuple('PathBase', ['bus', 'address'])
 class Path(PathBase):
-    def __init__(self, *args, **kw):
-        PathBase.__init__(self, *args, **kw)
-        assert os.path.exists(self.path), "%r %r" % (self.path, self)
-
     @property
     def path(self):
-        return '/dev/bus/usb/%03i/%03i' % (self.bus, self.address)
+        return '%s/%03i/%03i' % (DEV_ROOT, self.bus, self.address)
 
     def __str__(self):
         return self.path
@@ -44,18 +152,282 @@ Device = namedtuple('Device', ['path', 'vid', 'pid', 'serialno'])
 Device.__str__ = lambda self: "Device(%04x:%04x %s)" % (self.vid, self.pid, [self.path, repr(self.serialno)][bool(self.serialno)])
 #Device.__cmp__ = lambda a, b: cmp(a.path, b.path)
 
-def find_usb_devices_libusb():
-    class LibDevice(Device):
-        def inuse(self, dev=None):
+class DeviceSnapshot(object):
+    """What sysfs currently says about a device and its interfaces.
+
+    Everything is read in one pass, listing each of the device's sysfs
+    directories once and only reading the driver link for the interfaces
+    which have one. The tty and video devices come from DEVICE_NODES.
+    """
+    __slots__ = ("serialno", "interfaces", "drivers")
+
+    def __init__(self, syspaths):
+        self.serialno = None
+        self.interfaces = list(syspaths[1:])
+        # interface path -> driver name
+        self.drivers = {}
+
+        for i, path in enumerate(syspaths):
             try:
-                if dev is None:
-                    dev = usb.core.find(bus=self.path.bus, address=self.path.address)
+                names = os.listdir(path)
+            except OSError:
+                continue
+
+            if i == 0:
+                if "serial" in names:
+                    self.serialno = read_sysfs_attr(path, "serial")
+            elif "driver" in names:
+                self.drivers[path] = os.path.basename(
+                    os.readlink(os.path.join(path, "driver")))
+
+
+class SysDevice(Device):
+    """Device whose drivers and interfaces are found via sysfs.
 
-                #config = dev.get_active_configuration()
+    The first entry in syspaths is the device directory, the rest are the
+    interface directories. The drivers come from a snapshot taken the first
+    time they are needed, use refresh() to take a new one. The ttys and
+    video devices are looked up in DEVICE_NODES.
+    """
+
+    @property
+    def snapshot(self):
+        if not hasattr(self, "_snapshot"):
+            self._snapshot = DeviceSnapshot(self.syspaths)
+        return self._snapshot
+
+    def refresh(self):
+        self._snapshot = DeviceSnapshot(self.syspaths)
+        return self._snapshot
+
+    def inuse(self):
+        return bool(self.snapshot.drivers)
+
+    def drivers(self):
+        return tuple(sorted(set(self.snapshot.drivers.values())))
+
+    def detach(self):
+        for path in self.snapshot.drivers:
+            unbind_path = os.path.join(path, "driver", "unbind")
+            assert os.path.exists(unbind_path), unbind_path
+            interface = os.path.split(path)[-1]
+            open(unbind_path, "w").write(interface)
+        self.refresh()
+
+    def tty(self):
+        return DEVICE_NODES.ttys(os.path.basename(self.syspaths[0]))
+
+    def video(self):
+        return DEVICE_NODES.videos(os.path.basename(self.syspaths[0]))
+
+
+USB_INTERFACE_REGEX = re.compile(r"^(?P<device>[0-9]+-[0-9]+(\.[0-9]+)*):[0-9]+\.[0-9]+$")
+
+class DeviceNodeIndex(object):
+    """The /dev tty and video nodes of USB devices, indexed both ways.
+
+    Built from one pass over /sys/class/tty and /sys/class/video4linux,
+    whose entries link to the USB interface the node belongs to. Devices
+    are keyed on their position, so finding the ttys of a board or the
+    board a tty belongs to is a dictionary lookup.
+    """
+
+    CLASSES = [("tty", "sys/class/tty"), ("video", "sys/class/video4linux")]
+
+    def __init__(self, root=None):
+        self.root = root
+        self.lock = threading.RLock()
+        self.scanned = False
+        # /dev node -> position
+        self.by_node = {}
+        # position -> {"tty": [nodes], "video": [nodes]}
+        self.by_position = {}
+
+    def scan(self):
+        root = self.root or host_root()
+        by_node = {}
+        found = {}
+        for kind, classdir in self.CLASSES:
+            classpath = os.path.join(root, classdir)
+            try:
+                names = os.listdir(classpath)
+            except OSError:
+                continue
+            for name in names:
+                try:
+                    link = os.readlink(os.path.join(classpath, name))
+                except OSError:
+                    continue
+                for part in reversed(link.split("/")):
+                    match = USB_INTERFACE_REGEX.match(part)
+                    if match:
+                        break
+                else:
+                    # Not a USB device
+                    continue
+                node = "/dev/" + name
+                position = match.group("device")
+                by_node[node] = position
+                found.setdefault(position, {}).setdefault(kind, []).append((part, natural_key(name), node))
+
+        by_position = {}
+        for position, kinds in found.items():
+            by_position[position] = dict(
+                (kind, [node for _, _, node in sorted(nodes)]) for kind, nodes in kinds.items())
+
+        with self.lock:
+            self.by_node = by_node
+            self.by_position = by_position
+            self.scanned = True
+
+    def _nodes(self, position, kind):
+        with self.lock:
+            if not self.scanned:
+                self.scan()
+            return list(self.by_position.get(position, {}).get(kind, []))
+
+    def ttys(self, position):
+        return self._nodes(position, "tty")
+
+    def videos(self, position):
+        return self._nodes(position, "video")
+
+    def position(self, node):
+        """Position of the device which owns the /dev node, None if not a USB device."""
+        node = os.path.realpath(node) if os.path.islink(node) else os.path.normpath(node)
+        with self.lock:
+            if not self.scanned:
+                self.scan()
+            return self.by_node.get(node)
+
+    def attach(self, position, other, first=False):
+        """Make the nodes of the device at other belong to the one at position too."""
+        with self.lock:
+            nodes = self.by_position.setdefault(position, {})
+            for kind, extra in self.by_position.get(other, {}).items():
+                if first:
+                    nodes[kind] = extra + nodes.get(kind, [])
+                else:
+                    nodes[kind] = nodes.get(kind, []) + extra
+                for node in extra:
+                    self.by_node[node] = position
+
+
+def natural_key(name):
+    """Sort video10 after video9."""
+    return [int(s) if s.isdigit() else s for s in re.split(r"([0-9]+)", name)]
+
+DEVICE_NODES = DeviceNodeIndex()
+
+
+class LibusbContext(object):
+    """A libusb backend shared between scans, and the devices it found.
+
+    Without an explicit backend every usb.core.find() call creates a new
+    libusb context and enumerates the whole bus again. The usb.core.Device
+    objects are kept between scans (while the device stays at the same bus
+    and address) so the handle they open, and any string descriptors already
+    read, are reused.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.backend = None
+        # (bus, address) -> usb.core.Device
+        self.devices = {}
+
+    def scan(self):
+        import usb.core
+        import usb.util
+
+        with self.lock:
+            if self.backend is None:
+                import usb.backend.libusb1
+                self.backend = usb.backend.libusb1.get_backend()
+
+            found = {}
+            for dev in usb.core.find(find_all=True, backend=self.backend):
+                key = (dev.bus, dev.address)
+                old = self.devices.get(key)
+                if old is not None and (old.idVendor, old.idProduct) == (dev.idVendor, dev.idProduct):
+                    dev = old
+                found[key] = dev
+
+            for key, dev in self.devices.items():
+                if found.get(key) is not dev:
+                    usb.util.dispose_resources(dev)
+            self.devices = found
+            return list(found.values())
+
+    def get(self, path):
+        with self.lock:
+            return self.devices.get((path.bus, path.address))
+
+LIBUSB_CONTEXT = LibusbContext()
+
+
+class LibusbTransport(object):
+    """Same interface as UsbfsTransport but using an (already open) pyusb device."""
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.claimed = []
+
+    def close(self):
+        import usb.util
+        for interface in self.claimed:
+            usb.util.release_interface(self.dev, interface)
+        self.claimed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def control(self, request_type, request, value, index, data, timeout=1000):
+        result = self.dev.ctrl_transfer(request_type, request, value, index, data, timeout)
+        if request_type & USB_DIR_IN:
+            return bytearray(result)
+        return result
+
+    def claim_interface(self, interface):
+        import usb.util
+        usb.util.claim_interface(self.dev, interface)
+        self.claimed.append(interface)
+
+    def bulk(self, endpoint, data, timeout=1000):
+        if endpoint & USB_DIR_IN:
+            return bytearray(self.dev.read(endpoint, data, timeout))
+        return self.dev.write(endpoint, data, timeout)
+
+
+def find_usb_devices_libusb(ids=None, context=LIBUSB_CONTEXT):
+    """Find USB devices using libusb.
+
+    The bus is enumerated once per call and the serial number string
+    descriptor is only read for devices whose (vid, pid) is in ids (by
+    default the ones which could be boards). Each device keeps its pyusb
+    handle, which inuse(), detach() and transport() use directly.
+    """
+    class LibDevice(SysDevice):
+        def __new__(cls, handle, **kw):
+            self = Device.__new__(cls, **kw)
+            self.handle = handle
+            return self
+
+        @property
+        def syspaths(self):
+            if not hasattr(self, "_syspaths"):
+                self._syspaths = find_sys(self.path)
+            return self._syspaths
+
+        def inuse(self):
+            try:
                 active = False
-                for config in dev:
+                for config in self.handle:
                     for i, inf in enumerate(config):
-                        inf_active = dev.is_kernel_driver_active(inf.bInterfaceNumber)
+                        inf_active = self.handle.is_kernel_driver_active(inf.bInterfaceNumber)
                         active = active or inf_active
                 return active
             except usb.core.USBError:
@@ -63,60 +435,71 @@ def find_usb_devices_libusb():
 
         def detach(self):
             # Detach any driver currently attached.
-            dev = usb.core.find(bus=self.path.bus, address=self.path.address)
-
-            if not self.inuse(dev):
+            if not self.inuse():
                 return True
 
-            config = dev.get_active_configuration()
+            config = self.handle.get_active_configuration()
             for inf in config:
-                if dev.is_kernel_driver_active(inf.bInterfaceNumber):
-                    dev.detach_kernel_driver(inf.bInterfaceNumber)
+                if self.handle.is_kernel_driver_active(inf.bInterfaceNumber):
+                    self.handle.detach_kernel_driver(inf.bInterfaceNumber)
+            self.refresh()
+
+        def transport(self):
+            return LibusbTransport(self.handle)
 
     import usb
     if usb.__file__.endswith('.so'):
         logging.warning("Your python usb module is old.")
-    import usb.util
+    import usb.core
 
-    busses = usb.busses()
+    if ids is None:
+        ids = BOARD_REGISTRY.index
 
     devobjs = []
-    for dev in usb.core.find(find_all=True):
-        serialno = None
-        if dev.iSerialNumber > 0:
-            try:
-                serialno = dev.serial_number
-            except usb.USBError:
-                pass
+    with context.lock:
+        for dev in context.scan():
+            serialno = None
+            if dev.iSerialNumber > 0 and (dev.idVendor, dev.idProduct) in ids:
+                try:
+                    serialno = dev.serial_number
+                except usb.USBError:
+                    pass
+
+            devobjs.append(LibDevice(
+                dev, vid=dev.idVendor, pid=dev.idProduct, serialno=serialno,
+                path=Path(bus=dev.bus, address=dev.address)))
+
+    # Scanning sysfs after libusb has enumerated the bus (which it does using
+    # sysfs) means any device missing from it has gone away again already.
+    FIND_SYS_CACHE.scan()
+    found = []
+    for device in devobjs:
+        try:
+            device.syspaths
+        except KeyError:
+            logging.info("Skipping %s (no longer in sysfs)", device.path)
+            continue
+        found.append(device)
+    return found
 
-        devobjs.append(LibDevice(vid=dev.idVendor, pid=dev.idProduct, serialno=serialno, path=Path(bus=dev.bus, address=dev.address)))
-    return devobjs
 
 def find_usb_devices_lsusb():
-    import re
     import subprocess
 
-    FIND_SYS_CACHE.clear()
+    FIND_SYS_CACHE.scan()
 
     # 'Bus 002 Device 002: ID 8087:0024 Intel Corp. Integrated Rate Matching Hub'
     lsusb_device_regex = re.compile(
         "Bus (?P<bus>[0-9]+) Device (?P<address>[0-9]+):"
         " ID (?P<vid>[0-9a-f]+):(?P<pid>[0-9a-f]+)")
 
-    class LsusbDevice(Device):
+    class LsusbDevice(SysDevice):
         def __new__(cls, *args, **kw):
             return Device.__new__(cls, *args, serialno=None, **kw)
 
         @property
         def serialno(self):
-            # Get the serialno number from the device and cache it.
-            if not hasattr(self, "_serialno"):
-                serialnopath = os.path.join(self.syspaths[0], "serial")
-                if not os.path.exists(serialnopath):
-                    self._serialno = None
-                else:
-                    self._serialno = open(serialnopath, "r").read().strip()
-            return self._serialno
+            return self.snapshot.serialno
 
         @property
         def syspaths(self):
@@ -124,39 +507,12 @@ def find_usb_devices_lsusb():
                 self._syspaths = find_sys(self.path)
             return self._syspaths
 
-        def inuse(self):
-            return bool(self.drivers())
-
-        def drivers(self):
-            drivers = {}
-            for path in self.syspaths[1:]:
-                driver_path = os.path.join(path, "driver")
-                if os.path.exists(driver_path):
-                    drivers[path] = os.readlink(driver_path)
-            return tuple(set(d.split('/')[-1] for d in drivers.values()))
-
-        def detach(self):
-            for path in self.syspaths[1:]:
-                driver_path = os.path.join(path, "driver")
-                if os.path.exists(driver_path):
-                    unbind_path = os.path.join(driver_path, "unbind")
-                    assert os.path.exists(unbind_path), unbind_path
-                    interface = os.path.split(path)[-1]
-                    open(unbind_path, "w").write(interface)
-
-        def tty(self):
-            ttys = []
-            for path in self.syspaths:
-                tty_path = os.path.join(path, "tty")
-                if os.path.exists(tty_path):
-                    names = list(os.listdir(tty_path))
-                    assert len(names) == 1
-                    ttys.append('/dev/'+names[0])
-            return ttys
-
 
     devobjs = []
-    output = subprocess.check_output('lsusb')
+    if LSUSB_FILE:
+        output = open(LSUSB_FILE).read()
+    else:
+        output = subprocess.check_output('lsusb')
     for line in output.splitlines():
         bits = lsusb_device_regex.match(line)
         assert bits, repr(line)
@@ -171,16 +527,97 @@ def find_usb_devices_lsusb():
 
     return devobjs
 
-SYS_ROOT = '/sys/bus/usb/devices'
+
+USB_BACKENDS = ["sysfs", "libusb"]
+USB_BACKEND = os.environ.get("HDMI2USB_USB_BACKEND", "sysfs")
+
+def find_usb_devices(positions=None, backend=None):
+    """Find USB devices with the given backend (default $HDMI2USB_USB_BACKEND or sysfs)."""
+    backend = backend or USB_BACKEND
+    if backend == "libusb":
+        devices = find_usb_devices_libusb()
+        if positions is not None:
+            devices = [d for d in devices if os.path.basename(d.syspaths[0]) in positions]
+        return devices
+    assert backend == "sysfs", backend
+    return find_usb_devices_sysfs(positions=positions)
+
+
+def read_sysfs_attr(dirpath, name):
+    """Read a sysfs attribute, returning None if it doesn't exist."""
+    try:
+        with open(os.path.join(dirpath, name), 'r') as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+def find_usb_devices_sysfs(sys_root=None, positions=None):
+    """Find USB devices by reading /sys/bus/usb/devices directly.
+
+    Builds the device list from the (incrementally updated) FIND_SYS_CACHE,
+    avoiding both the lsusb fork and a second sysfs walk. If positions is
+    given only the devices plugged into those ports are looked at.
+    """
+    class SysfsDevice(SysDevice):
+        def __new__(cls, syspaths, **kw):
+            self = Device.__new__(cls, **kw)
+            self.syspaths = syspaths
+            return self
+
+        @property
+        def stale(self):
+            """Has the device re-enumerated (or gone away) since it was found?"""
+            cache.scan_port(os.path.basename(self.syspaths[0]))
+            return cache.is_stale(self.path)
+
+    if sys_root is None:
+        cache = FIND_SYS_CACHE
+    else:
+        cache = SysfsCache(sys_root)
+    devobjs = []
+    with cache.lock:
+        if positions is None:
+            cache.scan()
+            entries = cache.entries()
+        else:
+            entries = [cache.scan_port(p) for p in positions]
+        for entry in entries:
+            if entry is None or entry.path is None:
+                continue
+            devobjs.append(SysfsDevice(
+                syspaths=list(entry.syspaths),
+                vid=entry.vid,
+                pid=entry.pid,
+                serialno=entry.serialno,
+                path=entry.path,
+                ))
+    return devobjs
+
+
+POSITION_REGEX = re.compile(r"^(usb(?P<roothub>[0-9]+)|(?P<bus>[0-9]+)-(?P<ports>[0-9]+(\.[0-9]+)*))$")
+
+def parse_position(position):
+    """Split a position in the USB structure into (bus, ports).
+
+    1-2.3 -> (1, (2, 3)), usb1 (the root hub) -> (1, ())
+    """
+    match = POSITION_REGEX.match(position)
+    if not match:
+        raise ValueError("Invalid USB position %r" % (position,))
+    if match.group("roothub"):
+        return int(match.group("roothub")), ()
+    return int(match.group("bus")), tuple(int(p) for p in match.group("ports").split("."))
+
 
 def get_path_from_sysdir(dirpath):
     buspath = os.path.join(dirpath, 'busnum')
     devpath = os.path.join(dirpath, 'devnum')
     if not os.path.exists(buspath):
-        logging.info("Skipping %s (no busnum)", dirname)
+        logging.info("Skipping %s (no busnum)", dirpath)
         return None
     if not os.path.exists(devpath):
-        logging.info("Skipping %s (no devnum)", dirname)
+        logging.info("Skipping %s (no devnum)", dirpath)
         return None
 
     busnum = int(open(buspath, 'r').read().strip())
@@ -202,7 +639,8 @@ def create_sys_mapping():
         if ":" in dirname:
             continue
         path = get_path_from_sysdir(dirpath)
-        assert path
+        if path is None:
+            continue
         devices[dirpath] = path
         assert path not in interfaces
         interfaces[path] = [dirpath]
@@ -217,19 +655,192 @@ def create_sys_mapping():
             device = "usb%s" % (device[:-2])
 
         devpath = os.path.join(SYS_ROOT, device)
-        assert os.path.exists(devpath)
-        assert devpath in devices
+        if devpath not in devices:
+            logging.info("Skipping %s (no parent device)", dirname)
+            continue
 
         interfaces[devices[devpath]].append(dirpath)
 
     return interfaces
 
 
-FIND_SYS_CACHE = {}
+class SysfsEntry(object):
+    """Cached information about a single device directory in sysfs."""
+
+    def __init__(self, dirpath, version):
+        self.dirpath = dirpath
+        self.version = version
+        self.interfaces = []
+
+        self.devnum = read_sysfs_attr(dirpath, 'devnum')
+        busnum = read_sysfs_attr(dirpath, 'busnum')
+        vid = read_sysfs_attr(dirpath, 'idVendor')
+        pid = read_sysfs_attr(dirpath, 'idProduct')
+        if None in (busnum, self.devnum, vid, pid):
+            self.path = None
+            return
+
+        self.vid = int(vid, base=16)
+        self.pid = int(pid, base=16)
+        self.serialno = read_sysfs_attr(dirpath, 'serial')
+        self.path = Path(bus=int(busnum), address=int(self.devnum))
+        self.path.version = version
+
+    @property
+    def syspaths(self):
+        return [self.dirpath] + self.interfaces
+
+
+class SysfsCache(object):
+    """Incrementally updated map of the USB devices found in sysfs.
+
+    Each scan lists the sysfs root once, but only reads the attributes of
+    device directories which have appeared or whose devnum has changed (the
+    device re-enumerated). Every (re)read entry gets a new version which is
+    also attached to its Path, so holders of an old Path (or its syspaths)
+    can check whether it is stale.
+    """
+
+    def __init__(self, sys_root=None):
+        self.sys_root = sys_root
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        self._root = None
+        self._dirs = {}
+        self._paths = {}
+        self._version = 0
+
+    def _next_version(self):
+        self._version += 1
+        return self._version
+
+    def scan(self):
+        """Update the cache, returning (added, removed) directory names."""
+        with self.lock:
+            return self._scan()
+
+    def _scan(self):
+        sys_root = self.sys_root or SYS_ROOT
+        if sys_root != self._root:
+            self.clear()
+            self._root = sys_root
+
+        devices = set()
+        interfaces = {}
+        for dirname in os.listdir(sys_root):
+            if ":" not in dirname:
+                devices.add(dirname)
+                continue
+
+            device, interface = dirname.split(':')
+            if device.endswith('-0'):
+                device = "usb%s" % (device[:-2])
+            interfaces.setdefault(device, []).append(
+                os.path.join(sys_root, dirname))
+
+        removed = set(self._dirs) - devices
+        for dirname in removed:
+            del self._dirs[dirname]
+
+        added = set()
+        for dirname in devices:
+            entry = self._dirs.get(dirname)
+            if entry is not None:
+                devnum = read_sysfs_attr(entry.dirpath, 'devnum')
+                if devnum == entry.devnum:
+                    continue
+                logging.info("%s changed devnum %s -> %s", dirname, entry.devnum, devnum)
+            else:
+                added.add(dirname)
+
+            self._dirs[dirname] = SysfsEntry(
+                os.path.join(sys_root, dirname), self._next_version())
+
+        self._paths = {}
+        for dirname, entry in self._dirs.items():
+            entry.interfaces = list(sorted(interfaces.get(dirname, [])))
+            if entry.path is None:
+                logging.info("Skipping %s (missing busnum/devnum/idVendor/idProduct)", dirname)
+                continue
+            assert entry.path not in self._paths, entry.path
+            self._paths[entry.path] = entry
+
+        for device in set(interfaces) - devices:
+            logging.info("Skipping interfaces of %s (no parent device)", device)
+
+        return added, removed
+
+    def scan_port(self, position):
+        """Update just the device at position (like 1-2.3), returning its entry.
+
+        This doesn't list the sysfs root, so is O(1) in the number of
+        devices. Returns None if nothing is plugged into the port.
+        """
+        with self.lock:
+            sys_root = self.sys_root or SYS_ROOT
+            if sys_root != self._root:
+                self.clear()
+                self._root = sys_root
+
+            dirpath = os.path.join(sys_root, position)
+            old = self._dirs.get(position)
+            if old is not None and old.path is not None:
+                self._paths.pop(old.path, None)
+
+            try:
+                names = os.listdir(dirpath)
+            except OSError:
+                self._dirs.pop(position, None)
+                return None
+
+            entry = old
+            if old is None or read_sysfs_attr(dirpath, 'devnum') != old.devnum:
+                entry = SysfsEntry(dirpath, self._next_version())
+                self._dirs[position] = entry
+
+            # The interfaces are subdirectories of the device.
+            if position.startswith("usb"):
+                prefix = "%s-0:" % position[3:]
+            else:
+                prefix = position + ":"
+            entry.interfaces = list(sorted(
+                os.path.join(sys_root, n) for n in names if n.startswith(prefix)))
+
+            if entry.path is not None:
+                self._paths[entry.path] = entry
+            return entry
+
+    def entries(self):
+        return [self._dirs[d] for d in sorted(self._dirs) if self._dirs[d].path is not None]
+
+    def is_stale(self, path):
+        """Is path (or syspaths found for it) from an old version of a device?"""
+        entry = self._paths.get(path)
+        if entry is None:
+            return True
+        version = getattr(path, 'version', None)
+        return version is not None and version != entry.version
+
+    def __nonzero__(self):
+        return bool(self._paths)
+
+    def __getitem__(self, path):
+        return self._paths[path].syspaths
+
+
+FIND_SYS_CACHE = SysfsCache()
 def find_sys(path, mapping=FIND_SYS_CACHE):
-    if not mapping:
-        mapping.update(create_sys_mapping())
-    return mapping[path]
+    """The sysfs directories of the device at path, rescanning if it's new.
+
+    Raises KeyError if the device isn't there (any more).
+    """
+    try:
+        return mapping[path]
+    except KeyError:
+        mapping.scan()
+        return mapping[path]
 
 
 def test_libusb_and_lsusb_equal():
@@ -249,43 +860,2090 @@ def test_libusb_and_lsusb_equal():
             assert libobj_inuse == lsobj_inuse, "%r == %r" % (libobj_inuse, lsobj_inuse)
 
 
-BOARD_TYPES = ['opsis', 'atlys']
-BOARD_NAMES = {
-    'atlys': "Digilent Atlys",
-    'opsis': "Numato Opsis",
-    }
+def test_lsusb_and_sysfs_equal():
+    lsusb_devices = find_usb_devices_lsusb()
+    sysfs_devices = find_usb_devices_sysfs()
+    assert len(lsusb_devices) == len(sysfs_devices), "%r == %r" % (len(lsusb_devices), len(sysfs_devices))
+    for lsobj, sysobj in zip(sorted(lsusb_devices), sorted(sysfs_devices)):
+        assert lsobj.path == sysobj.path, "%r == %r" % (lsobj.path, sysobj.path)
+        assert lsobj.vid == sysobj.vid, "%r == %r" % (lsobj.vid, sysobj.vid)
+        assert lsobj.pid == sysobj.pid, "%r == %r" % (lsobj.pid, sysobj.pid)
+        assert lsobj.serialno == sysobj.serialno, "%r == %r" % (lsobj.serialno, sysobj.serialno)
+        assert lsobj.syspaths == sysobj.syspaths, "%r == %r" % (lsobj.syspaths, sysobj.syspaths)
+        assert lsobj.drivers() == sysobj.drivers(), "%r == %r" % (lsobj.drivers(), sysobj.drivers())
+
+
 BOARD_STATES = ['unconfigured', 'jtag', 'serial', 'operational']
 
-USBJTAG_MAPPING = {
-    'hw_nexys': 'atlys',
-    'hw_opsis': 'opsis',
-    }
-USBJTAG_RMAPPING = {v:k for k,v in USBJTAG_MAPPING.items()}
+TOPDIR = os.path.dirname(os.path.realpath(__file__))
+
+# Extra board definition files can be given in $HDMI2USB_BOARDS (separated by
+# os.pathsep), definitions in later files override earlier ones.
+BOARD_FILES = [os.path.join(TOPDIR, "boards.json")] + [
+    f for f in os.environ.get("HDMI2USB_BOARDS", "").split(os.pathsep) if f]
+
+class BoardRegistry(object):
+    """Board definitions, indexed on (vid, pid) to classify USB devices.
+
+    A definition file has a "boards" section giving the name of each board
+    type and the firmware (relative to the file) used for each mode, an
+    "ids" section mapping a vid, pid and optional serial number to a board
+    type and state, and a "uarts" section of the vid and pid of USB-UARTs
+    which are part of a board type but a separate USB device.
+    """
+
+    def __init__(self, filenames=()):
+        self.boards = {}
+        # (vid, pid) -> {serialno or None: (type, state)}
+        self.index = {}
+        # (vid, pid) -> type
+        self.uarts = {}
+        for filename in filenames:
+            self.load(filename)
+
+    def load(self, filename):
+        import json
+
+        data = json.load(open(filename, "r"))
+        basedir = os.path.dirname(os.path.abspath(filename))
+
+        for board_type, info in data.get("boards", {}).items():
+            board_type = str(board_type)
+            board = self.boards.setdefault(
+                board_type, {"name": board_type, "firmware": {}})
+            board["name"] = info.get("name", board["name"])
+            for mode, firmware in info.get("firmware", {}).items():
+                assert_in(mode, BOARD_STATES)
+                board["firmware"][str(mode)] = os.path.join(basedir, firmware)
+
+        for entry in data.get("ids", []):
+            assert_in(entry["type"], self.boards)
+            assert_in(entry["state"], BOARD_STATES)
+            key = (int(entry["vid"], 16), int(entry["pid"], 16))
+            serial = entry.get("serial")
+            if serial is not None:
+                serial = str(serial)
+            self.index.setdefault(key, {})[serial] = (
+                str(entry["type"]), str(entry["state"]))
+
+        for entry in data.get("uarts", []):
+            assert_in(entry["type"], self.boards)
+            self.uarts[(int(entry["vid"], 16), int(entry["pid"], 16))] = str(entry["type"])
+
+    @property
+    def types(self):
+        return list(sorted(self.boards))
+
+    def name(self, board_type):
+        return self.boards[board_type]["name"]
+
+    def firmware(self, board_type, mode):
+        try:
+            return self.boards[board_type]["firmware"][mode]
+        except KeyError:
+            raise SystemError("No firmware for %s mode on %s." % (mode, board_type))
+
+    def classify(self, device):
+        """Return (type, state) for device, or None if it isn't a board."""
+        serials = self.index.get((device.vid, device.pid))
+        if serials is None:
+            return None
+        # Only look at the serial number if it could change the answer.
+        if len(serials) == 1 and None in serials:
+            return serials[None]
+
+        match = serials.get(device.serialno, serials.get(None))
+        if match is None:
+            logging.warn("Unknown %04x:%04x device! %r (%s)",
+                device.vid, device.pid, device.serialno, device)
+        return match
+
+    def uart_type(self, device):
+        """Return the type of board device is the separate USB-UART of, or None."""
+        return self.uarts.get((device.vid, device.pid))
+
+    def has_uart(self, device):
+        """Is device a board which can have a separate USB-UART?"""
+        match = self.classify(device)
+        return match is not None and match[0] in self.uarts.values()
+
+
+BOARD_REGISTRY = BoardRegistry(BOARD_FILES)
+BOARD_TYPES = BOARD_REGISTRY.types
+BOARD_NAMES = dict((t, BOARD_REGISTRY.name(t)) for t in BOARD_TYPES)
 
 BoardBase = namedtuple("Board", ["dev", "type", "state"])
 class Board(BoardBase):
     def tty(self):
         return self.dev.tty()
 
+    def video(self):
+        return self.dev.video()
+
+    @property
+    def position(self):
+        """Position in the USB structure, for example 1-2.3."""
+        return os.path.basename(self.dev.syspaths[0])
+
+IHexSegment = namedtuple("IHexSegment", ["address", "data"])
+
+def parse_ihex(filename):
+    """Parse an Intel HEX (.hex / .ihx) file into a list of IHexSegment."""
+    import binascii
+
+    segments = []
+    base = 0
+    for lineno, line in enumerate(open(filename, "r"), 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith(":"):
+            raise ValueError("%s:%s: not an Intel HEX record" % (filename, lineno))
+
+        raw = bytearray(binascii.unhexlify(line[1:]))
+        if len(raw) < 5 or len(raw) != raw[0] + 5:
+            raise ValueError("%s:%s: bad record length" % (filename, lineno))
+        if sum(raw) & 0xff:
+            raise ValueError("%s:%s: bad checksum" % (filename, lineno))
+
+        count, address, rtype = raw[0], (raw[1] << 8) | raw[2], raw[3]
+        data = raw[4:4+count]
+
+        # Data
+        if rtype == 0x00:
+            segments.append(IHexSegment(base + address, data))
+        # End of file
+        elif rtype == 0x01:
+            break
+        # Extended segment / linear address
+        elif rtype == 0x02:
+            base = ((data[0] << 8) | data[1]) << 4
+        elif rtype == 0x04:
+            base = ((data[0] << 8) | data[1]) << 16
+        # Start segment / linear address don't mean anything on the FX2
+        else:
+            continue
+
+    return segments
+
+
+def merge_segments(segments, max_size):
+    """Merge adjacent segments and split the result into max_size writes.
+
+    Segments are overlaid in order, so a later record that overlaps an
+    earlier one wins (as it would when writing them one at a time).
+    """
+    # Already merged (for example, from the firmware cache), which is only
+    # the case if a segment only follows straight on from a full one.
+    end = -1
+    full = True
+    for segment in segments:
+        if segment.address < end or (segment.address == end and not full):
+            break
+        if len(segment.data) > max_size:
+            break
+        end = segment.address + len(segment.data)
+        full = len(segment.data) == max_size
+    else:
+        return list(segments)
+
+    image = {}
+    for segment in segments:
+        for i, byte in enumerate(segment.data):
+            image[segment.address + i] = byte
+
+    merged = []
+    for address in sorted(image):
+        if merged and merged[-1].address + len(merged[-1].data) == address:
+            merged[-1].data.append(image[address])
+        else:
+            merged.append(IHexSegment(address, bytearray([image[address]])))
+
+    chunks = []
+    for segment in merged:
+        for offset in range(0, len(segment.data), max_size):
+            chunks.append(IHexSegment(
+                segment.address + offset, segment.data[offset:offset+max_size]))
+    return chunks
+
+
+USB_DIR_OUT = 0x00
+USB_DIR_IN = 0x80
+USB_TYPE_VENDOR = 0x40
+
+class UsbfsTransport(object):
+    """Control transfers through a /dev/bus/usb node using the usbfs ioctls."""
+
+    def __init__(self, path):
+        import ctypes
+
+        class CtrlTransfer(ctypes.Structure):
+            _fields_ = [
+                ("bRequestType", ctypes.c_uint8),
+                ("bRequest", ctypes.c_uint8),
+                ("wValue", ctypes.c_uint16),
+                ("wIndex", ctypes.c_uint16),
+                ("wLength", ctypes.c_uint16),
+                ("timeout", ctypes.c_uint32),
+                ("data", ctypes.c_void_p),
+                ]
+
+        class BulkTransfer(ctypes.Structure):
+            _fields_ = [
+                ("ep", ctypes.c_uint),
+                ("len", ctypes.c_uint),
+                ("timeout", ctypes.c_uint),
+                ("data", ctypes.c_void_p),
+                ]
+
+        self._ctypes = ctypes
+        self._CtrlTransfer = CtrlTransfer
+        self._BulkTransfer = BulkTransfer
+        # _IOWR('U', 0, struct usbdevfs_ctrltransfer)
+        self._USBDEVFS_CONTROL = (
+            (3 << 30) | (ctypes.sizeof(CtrlTransfer) << 16) | (ord('U') << 8) | 0)
+        # _IOWR('U', 2, struct usbdevfs_bulktransfer)
+        self._USBDEVFS_BULK = (
+            (3 << 30) | (ctypes.sizeof(BulkTransfer) << 16) | (ord('U') << 8) | 2)
+        # _IOR('U', 15, unsigned int) and _IOR('U', 16, unsigned int)
+        self._USBDEVFS_CLAIMINTERFACE = (2 << 30) | (4 << 16) | (ord('U') << 8) | 15
+        self._USBDEVFS_RELEASEINTERFACE = (2 << 30) | (4 << 16) | (ord('U') << 8) | 16
+
+        self.path = str(path)
+        self.fd = os.open(self.path, os.O_RDWR)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def control(self, request_type, request, value, index, data, timeout=1000):
+        """Do a control transfer.
+
+        For OUT transfers data is the bytes to send and the number of bytes
+        sent is returned. For IN transfers data is the number of bytes to read
+        and the bytes read are returned.
+        """
+        import fcntl
+        ctypes = self._ctypes
+
+        if request_type & USB_DIR_IN:
+            buf = ctypes.create_string_buffer(data)
+            length = data
+        else:
+            buf = ctypes.create_string_buffer(bytes(data), len(data))
+            length = len(data)
+
+        xfer = self._CtrlTransfer(
+            request_type, request, value, index, length, timeout,
+            ctypes.cast(buf, ctypes.c_void_p))
+        transferred = fcntl.ioctl(self.fd, self._USBDEVFS_CONTROL, xfer, True)
+
+        if request_type & USB_DIR_IN:
+            return bytearray(buf.raw[:transferred])
+        return transferred
+
+    def claim_interface(self, interface):
+        import fcntl
+        fcntl.ioctl(self.fd, self._USBDEVFS_CLAIMINTERFACE, self._ctypes.c_uint(interface))
+
+    def release_interface(self, interface):
+        import fcntl
+        fcntl.ioctl(self.fd, self._USBDEVFS_RELEASEINTERFACE, self._ctypes.c_uint(interface))
+
+    def bulk(self, endpoint, data, timeout=1000):
+        """Do a bulk transfer, same conventions for data as control()."""
+        import fcntl
+        ctypes = self._ctypes
+
+        if endpoint & USB_DIR_IN:
+            buf = ctypes.create_string_buffer(data)
+            length = data
+        else:
+            # The kernel only reads an OUT buffer, so send data without a copy.
+            buf = ctypes.c_char_p(data)
+            length = len(data)
+
+        xfer = self._BulkTransfer(endpoint, length, timeout, ctypes.cast(buf, ctypes.c_void_p))
+        transferred = fcntl.ioctl(self.fd, self._USBDEVFS_BULK, xfer, True)
+
+        if endpoint & USB_DIR_IN:
+            return bytearray(buf.raw[:transferred])
+        return transferred
+
+
+# The VirtualFx2Host (from hdmi2usb_testing.py) simulating the boards, while one is installed.
+VIRTUAL_FX2 = None
+
+def open_transport(device):
+    """Get a transport for control and bulk transfers to device.
+
+    Reuses the device's own handle when it has one (libusb backend),
+    otherwise opens its usbfs node.
+    """
+    if VIRTUAL_FX2 is not None:
+        return VIRTUAL_FX2.transport(device)
+    if hasattr(device, "transport"):
+        return device.transport()
+    return UsbfsTransport(device.path)
+
+
+class Fx2LoadError(IOError):
+    pass
+
+
+FX2_CPUCS = 0xE600
+FX2_REQUEST_FIRMWARE_LOAD = 0xA0
+# The 0xA0 request can only write the internal program/data RAM and the
+# scratch RAM, anything else needs a second stage loader.
+FX2_INTERNAL_MEMORY = [(0x0000, 0x4000), (0xE000, 0xE200)]
+FX2_MAX_WRITE = 4096
+
+def fx2_write(transport, address, data):
+    sent = transport.control(
+        USB_DIR_OUT | USB_TYPE_VENDOR, FX2_REQUEST_FIRMWARE_LOAD,
+        address, 0, data)
+    if sent != len(data):
+        raise Fx2LoadError("Short write at 0x%04x (%s of %s bytes)" % (
+            address, sent, len(data)))
+
+
+def fx2_read(transport, address, length):
+    return transport.control(
+        USB_DIR_IN | USB_TYPE_VENDOR, FX2_REQUEST_FIRMWARE_LOAD,
+        address, 0, length)
+
+
+def fx2_load(transport, segments, verify=False):
+    """Load segments onto an FX2 by holding the 8051 in reset (via CPUCS),
+    writing the image and then letting it run.
+
+    Adjacent segments are merged so the image goes down in as few (large)
+    control transfers as possible. Returns the time taken by each phase.
+    """
+    chunks = merge_segments(segments, FX2_MAX_WRITE)
+    for chunk in chunks:
+        end = chunk.address + len(chunk.data)
+        if not any(start <= chunk.address and end <= stop for start, stop in FX2_INTERNAL_MEMORY):
+            raise Fx2LoadError("0x%04x-0x%04x is not in the FX2 internal memory" % (
+                chunk.address, end))
+
+    timings = []
+
+    starttime = time.time()
+    fx2_write(transport, FX2_CPUCS, bytearray([0x01]))
+    timings.append(("reset", time.time() - starttime))
+
+    starttime = time.time()
+    for chunk in chunks:
+        fx2_write(transport, chunk.address, chunk.data)
+    timings.append(("download", time.time() - starttime))
+
+    if verify:
+        starttime = time.time()
+        for chunk in chunks:
+            data = fx2_read(transport, chunk.address, len(chunk.data))
+            if data != chunk.data:
+                raise Fx2LoadError("Verify failed at 0x%04x" % chunk.address)
+        timings.append(("verify", time.time() - starttime))
+
+    # The FX2 may disconnect (and re-enumerate) as soon as it starts running,
+    # so the status of this transfer doesn't mean much.
+    starttime = time.time()
+    try:
+        fx2_write(transport, FX2_CPUCS, bytearray([0x00]))
+    except EnvironmentError as e:
+        logging.info("Ignoring error releasing FX2 from reset: %s", e)
+    timings.append(("run", time.time() - starttime))
+
+    return timings
+
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "hdmi2usb-mode-switch")
+FIRMWARE_CACHE_DIR = os.path.join(CACHE_DIR, "fx2")
+
+FirmwareImage = namedtuple("FirmwareImage", ["filename", "sha256", "segments"])
+
+# Compiled firmware is a header, a table of (address, length) pairs and then
+# the data for each segment. The segments are already merged into
+# FX2_MAX_WRITE sized writes.
+FIRMWARE_CACHE_MAGIC = "FX2SEGS1"
+
+def compile_firmware(filename, sha256, cache_dir=FIRMWARE_CACHE_DIR):
+    """Parse filename and write it into the cache, returning the segments."""
+    import struct
+    import tempfile
+
+    segments = merge_segments(parse_ihex(filename), FX2_MAX_WRITE)
+
+    data = [struct.pack("<8sI", FIRMWARE_CACHE_MAGIC, len(segments))]
+    for segment in segments:
+        data.append(struct.pack("<II", segment.address, len(segment.data)))
+    for segment in segments:
+        data.append(bytes(segment.data))
+
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmpname = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, "wb") as f:
+            f.write("".join(data))
+        os.rename(tmpname, os.path.join(cache_dir, sha256))
+    except EnvironmentError as e:
+        logging.warning("Unable to cache firmware %s: %s", filename, e)
+
+    return segments
+
+
+def read_compiled_firmware(cachename):
+    import mmap
+    import struct
+
+    with open(cachename, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, count = struct.unpack_from("<8sI", mm, 0)
+        if magic != FIRMWARE_CACHE_MAGIC:
+            raise ValueError("%s is not a compiled firmware" % cachename)
+
+        table = struct.calcsize("<8sI")
+        offset = table + count * struct.calcsize("<II")
+        segments = []
+        for i in range(count):
+            address, length = struct.unpack_from("<II", mm, table + i * 8)
+            segments.append(IHexSegment(address, bytearray(mm[offset:offset+length])))
+            offset += length
+        if offset != len(mm):
+            raise ValueError("%s is truncated" % cachename)
+        return segments
+    finally:
+        mm.close()
+
+
+def load_firmware_image(filename, cache_dir=FIRMWARE_CACHE_DIR):
+    """Get the segments for a firmware file, using the compiled cache.
+
+    The cache is keyed on the sha256 of the source file, so an updated
+    source never picks up a stale compiled image.
+    """
+    import hashlib
+
+    sha256 = hashlib.sha256(open(filename, "rb").read()).hexdigest()
+    cachename = os.path.join(cache_dir, sha256)
+    if os.path.exists(cachename):
+        try:
+            return FirmwareImage(filename, sha256, read_compiled_firmware(cachename))
+        except (ValueError, EnvironmentError) as e:
+            logging.warning("Recompiling firmware %s: %s", filename, e)
+    return FirmwareImage(filename, sha256, compile_firmware(filename, sha256, cache_dir))
+
+
+def build_firmware_cache(registry=BOARD_REGISTRY, cache_dir=FIRMWARE_CACHE_DIR):
+    """Compile every firmware in the board registry, returning the images."""
+    filenames = set()
+    for board in registry.boards.values():
+        filenames.update(board["firmware"].values())
+    return [load_firmware_image(f, cache_dir) for f in sorted(filenames)]
+
+
+FirmwareDescriptor = namedtuple("FirmwareDescriptor", ["vid", "pid", "bcd", "strings"])
+
+USB_DEVICE_DESCRIPTOR_REGEX = re.compile(
+    # bLength, bDescriptorType, bcdUSB 1.0/1.1/2.0, class/subclass/protocol, bMaxPacketSize0
+    r"\x12\x01(?:\x00\x01|\x10\x01|\x00\x02)...[\x08\x10\x20\x40]"
+    r"(?P<vid>..)(?P<pid>..)(?P<bcd>..)", re.DOTALL)
+USB_STRING_DESCRIPTOR_REGEX = re.compile(r"(?P<length>[\x04-\xfe])\x03(?P<string>(?:[\x20-\x7e]\x00)+)")
+
+def firmware_descriptor(segments):
+    """Find the USB device descriptor (and string descriptors) in a firmware image.
+
+    This is what the board will report once it is running the firmware, so
+    it can be compared with what a board is reporting now. Returns None if
+    no device descriptor is found.
+    """
+    memory = bytearray(0x10000)
+    for segment in segments:
+        memory[segment.address:segment.address+len(segment.data)] = segment.data
+    memory = str(memory)
+
+    match = USB_DEVICE_DESCRIPTOR_REGEX.search(memory)
+    if not match:
+        return None
+    le16 = lambda s: ord(s[0]) | ord(s[1]) << 8
+
+    strings = set()
+    for string in USB_STRING_DESCRIPTOR_REGEX.finditer(memory):
+        if ord(string.group("length")) == 2 + len(string.group("string")):
+            strings.add(string.group("string").decode("utf-16-le"))
+
+    return FirmwareDescriptor(
+        vid=le16(match.group("vid")),
+        pid=le16(match.group("pid")),
+        bcd=le16(match.group("bcd")),
+        strings=frozenset(strings))
+
+
 def load_fx2(board, filename, verbose=False):
     if board.dev.inuse():
         if verbose:
             sys.stderr.write("Detaching drivers from board.\n")
-        board.dev.detach()
+        with TRACE.span("detach", board=board.position, drivers=board.dev.drivers()):
+            board.dev.detach()
 
     filepath = os.path.abspath(filename)
     assert os.path.exists(filepath), filepath
 
-    cmdline = "fxload -t fx2lp".split()
-    cmdline += ["-D", str(board.dev.path)]
-    cmdline += ["-I", filepath]
+    image = load_firmware_image(filepath)
     if verbose:
-        cmdline += ["-v",]
+        sys.stderr.write("Loading %s (sha256 %s) onto %s\n" % (
+            filepath, image.sha256, board.dev.path))
+
+    with TRACE.span("load_fx2", board=board.position, type=board.type,
+                    firmware=filepath, sha256=image.sha256) as span:
+        with open_transport(board.dev) as transport:
+            timings = fx2_load(transport, image.segments, verify=verbose > 1)
+        span.set(**dict(timings))
 
     if verbose:
-        sys.stderr.write("Running %r\n" % " ".join(cmdline))
+        sys.stderr.write("Loaded %s bytes (%s)\n" % (
+            sum(len(s.data) for s in image.segments),
+            ", ".join("%s %.3fs" % t for t in timings)))
+    return timings
+
+
+# The ixo-usb-jtag firmware speaks the USB-Blaster protocol on its bulk OUT
+# endpoint. A byte with bit 7 clear sets the JTAG pins directly, a byte with
+# bit 7 set is followed by (byte & 0x3f) bytes which are clocked out on TDI
+# (least significant bit first) with TMS held low.
+JTAG_EP_OUT = 0x02
+JTAG_INTERFACE = 0
+
+JTAG_TCK = 1 << 0
+JTAG_TMS = 1 << 1
+JTAG_TDI = 1 << 4
+# nCE, nCS and the LED
+JTAG_OTHERS = (1 << 2) | (1 << 3) | (1 << 5)
+JTAG_SHIFT = 1 << 7
+JTAG_MAX_SHIFT = 63
+
+# Data bytes per bulk transfer, which encodes into exactly 16kB.
+JTAG_CHUNK = JTAG_MAX_SHIFT * 256
+
+# Spartan-6 instructions (6 bit instruction register)
+XC6S_IR_LENGTH = 6
+XC6S_JPROGRAM = 0x0B
+XC6S_CFG_IN = 0x05
+XC6S_JSTART = 0x0C
+
+# Reverse the bits in each byte, the FPGA wants each configuration byte most
+# significant bit first but JTAG shifts least significant bit first.
+BIT_REVERSE = "".join(chr(int("{:08b}".format(i)[::-1], 2)) for i in range(256))
+
+
+class GatewareError(IOError):
+    pass
+
+
+def jtag_clock(tms, tdi=0):
+    """Bit-bang a single TCK cycle."""
+    pins = JTAG_OTHERS | [0, JTAG_TMS][tms] | [0, JTAG_TDI][tdi]
+    return chr(pins) + chr(pins | JTAG_TCK)
+
+
+def jtag_tms(bits):
+    return "".join(jtag_clock(tms) for tms in bits)
+
+
+def jtag_shift_bits(value, length, exit=True):
+    """Shift length bits of value on TDI, leaving the Shift state on the last one."""
+    return "".join(
+        jtag_clock(exit and i == length - 1, (value >> i) & 1) for i in range(length))
+
+
+def jtag_shift_bytes(data):
+    """Shift data (already in the order it should go on the wire) in byte-shift mode."""
+    return "".join(
+        chr(JTAG_SHIFT | len(data[i:i+JTAG_MAX_SHIFT])) + data[i:i+JTAG_MAX_SHIFT]
+        for i in range(0, len(data), JTAG_MAX_SHIFT))
+
+
+# TAP state transitions, all starting and finishing in Run-Test/Idle.
+JTAG_RESET = jtag_tms([1, 1, 1, 1, 1, 0])
+JTAG_TO_SHIFT_IR = jtag_tms([1, 1, 0, 0])
+JTAG_TO_SHIFT_DR = jtag_tms([1, 0, 0])
+# From Exit1 through Update back to Run-Test/Idle
+JTAG_FROM_EXIT1 = jtag_tms([1, 0])
+
+
+def jtag_instruction(instruction, length=XC6S_IR_LENGTH):
+    return JTAG_TO_SHIFT_IR + jtag_shift_bits(instruction, length) + JTAG_FROM_EXIT1
+
+
+def read_bitstream(filename):
+    """Memory map a .bit or .bin file, returning (mmap, offset, length) of the configuration data.
+
+    A .bit file has a header of tagged fields before the raw configuration
+    data, a .bin file is just the raw data.
+    """
+    import mmap
+    import struct
+
+    with open(filename, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if not filename.endswith(".bit"):
+        return data, 0, len(data)
+
+    try:
+        # Skip the opaque first field and the 0x0001 after it.
+        length, = struct.unpack(">H", data[0:2])
+        offset = 2 + length + 2
+        while True:
+            tag = data[offset]
+            offset += 1
+            if tag == "e":
+                length, = struct.unpack(">I", data[offset:offset+4])
+                offset += 4
+                break
+            length, = struct.unpack(">H", data[offset:offset+2])
+            offset += 2 + length
+    except (struct.error, IndexError):
+        raise GatewareError("%s isn't a valid .bit file" % filename)
+
+    if offset + length > len(data):
+        raise GatewareError("%s is truncated (%s of %s bytes)" % (
+            filename, len(data) - offset, length))
+    return data, offset, length
+
+
+def jtag_bitstream_chunks(data, offset, length, chunk=JTAG_CHUNK):
+    """Encode the configuration data as JTAG byte-shift commands, a bulk transfer at a time.
+
+    The very last bit has to be shifted with TMS high, so the last byte is
+    bit-banged.
+    """
+    end = offset + length - 1
+    for start in range(offset, end, chunk):
+        yield jtag_shift_bytes(data[start:min(start+chunk, end)].translate(BIT_REVERSE))
+    yield jtag_shift_bits(ord(data[end].translate(BIT_REVERSE)), 8) + JTAG_FROM_EXIT1
+
+
+def jtag_write(transport, data):
+    sent = transport.bulk(JTAG_EP_OUT, data)
+    if sent != len(data):
+        raise GatewareError("Short bulk write (%s of %s bytes)" % (sent, len(data)))
+
+
+def jtag_load_bitstream(transport, data, offset, length):
+    """Configure a Spartan-6 with the bitstream in data[offset:offset+length].
+
+    The data is encoded by a second thread while the previous chunk is being
+    transferred, so reading and encoding overlap with the USB transfers.
+
+    Returns a list of (phase, secs) timings.
+    """
+    import Queue
+
+    timings = []
+    starttime = time.time()
+    jtag_write(transport, JTAG_RESET + jtag_instruction(XC6S_JPROGRAM) + jtag_tms([0] * 64))
+    # Give the FPGA time to clear its configuration memory.
+    time.sleep(0.01)
+    jtag_write(transport, jtag_instruction(XC6S_CFG_IN) + JTAG_TO_SHIFT_DR)
+    timings.append(("program", time.time() - starttime))
+
+    starttime = time.time()
+    chunks = Queue.Queue(2)
+    def encode():
+        try:
+            for chunk in jtag_bitstream_chunks(data, offset, length):
+                chunks.put(chunk)
+        finally:
+            chunks.put(None)
+    encoder = threading.Thread(target=encode)
+    encoder.daemon = True
+    encoder.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            jtag_write(transport, chunk)
+    finally:
+        # Unblock the encoder if the transfer failed.
+        while encoder.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        encoder.join()
+    timings.append(("download", time.time() - starttime))
+
+    starttime = time.time()
+    jtag_write(transport, jtag_instruction(XC6S_JSTART) + jtag_tms([0] * 32) + JTAG_RESET)
+    timings.append(("start", time.time() - starttime))
+    return timings
+
+
+def load_gateware(board, filename, verbose=False, transport=None):
+    """Load a .bit/.bin file onto the FPGA of a board in jtag mode."""
+    if board.state != "jtag":
+        raise GatewareError("Board at %s needs to be in jtag mode not %s" % (
+            board.position, board.state))
+
+    if board.dev.inuse():
+        with TRACE.span("detach", board=board.position, drivers=board.dev.drivers()):
+            board.dev.detach()
+
+    data, offset, length = read_bitstream(os.path.abspath(filename))
+    try:
+        with TRACE.span("load_gateware", board=board.position, type=board.type,
+                        gateware=filename, size=length) as span:
+            if transport is None:
+                transport = open_transport(board.dev)
+            with transport:
+                transport.claim_interface(JTAG_INTERFACE)
+                timings = jtag_load_bitstream(transport, data, offset, length)
+            span.set(**dict(timings))
+    finally:
+        data.close()
+
+    download = dict(timings)["download"]
+    if verbose:
+        sys.stderr.write("Loaded %s bytes of gateware in %.2fs (%.2f MB/s, %s)\n" % (
+            length, sum(secs for _, secs in timings),
+            length / max(download, 1e-6) / 1e6,
+            ", ".join("%s %.3fs" % t for t in timings)))
+    return timings
+
+
+NETLINK_KOBJECT_UEVENT = 15
+
+class UsbEventWaiter(object):
+    """Wait for USB devices to be added or removed.
+
+    Listens for kernel uevents on a netlink socket so a wait finishes as soon
+    as a USB device appears or disappears. If the socket can't be opened
+    (non-Linux, sandboxed, etc) it falls back to just sleeping for the poll
+    interval.
+
+    Create the waiter *before* doing the thing which causes the
+    re-enumeration so no events are missed.
+
+    Devices added or removed by this process (like the virtual boards) don't
+    generate uevents, so notify() wakes up every waiter instead.
+    """
+
+    POLL_INTERVAL = 1.0
+
+    _notify_fds = set()
+    _notify_lock = threading.Lock()
+
+    def __init__(self, poll_interval=None, subsystems=("usb",)):
+        if poll_interval is not None:
+            self.POLL_INTERVAL = poll_interval
+        self.subsystems = ["\0SUBSYSTEM=%s\0" % s for s in subsystems]
+
+        import fcntl
+        self.pipe = os.pipe()
+        for fd in self.pipe:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        with self._notify_lock:
+            self._notify_fds.add(self.pipe[1])
+
+        self.sock = None
+        try:
+            import socket
+            sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, 1))
+            sock.setblocking(False)
+            self.sock = sock
+        except (AttributeError, EnvironmentError) as e:
+            logging.info("No uevent socket (%s), falling back to polling.", e)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.pipe is not None:
+            with self._notify_lock:
+                self._notify_fds.discard(self.pipe[1])
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+            self.pipe = None
+
+    @classmethod
+    def notify(cls):
+        """Wake up all the waiters, as if a USB device was added or removed."""
+        with cls._notify_lock:
+            for fd in cls._notify_fds:
+                try:
+                    os.write(fd, "\0")
+                except EnvironmentError:
+                    # Full, so the waiter has a wake up pending anyway.
+                    pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _drain(self):
+        """Read all pending uevents, returning True if any were interesting."""
+        found = False
+        while True:
+            try:
+                msg = self.sock.recv(16384)
+            except EnvironmentError:
+                return found
+            if not msg:
+                return found
+            if any(s in msg for s in self.subsystems):
+                found = True
+
+    def wait(self, timeout=None):
+        """Wait up to timeout (or the poll interval) for a USB add/remove.
+
+        Returns True if a USB event was seen, False if the wait timed out.
+        """
+        if timeout is None or timeout > self.POLL_INTERVAL:
+            timeout = self.POLL_INTERVAL
+        timeout = max(timeout, 0)
+
+        import select
+        fds = [self.pipe[0]] + [[self.sock], []][self.sock is None]
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select(fds, [], [], remaining)
+            if self.pipe[0] in readable:
+                try:
+                    while os.read(self.pipe[0], 4096):
+                        pass
+                except EnvironmentError:
+                    pass
+                return True
+            if readable and self._drain():
+                return True
+
+
+class SwitchTimeout(SystemError):
+    pass
+
+
+class SwitchWrongState(SystemError):
+    pass
+
+
+def wait_for_board(args, old_board, newmode, events, timeout=None):
+    """Wait for old_board to re-enumerate in newmode.
+
+    Checks again every time a USB device is added or removed (or every poll
+    interval as a fallback) until the board shows up or timeout expires.
+
+    A board's identity is the physical port it is plugged into (its
+    position), which stays the same when it re-enumerates with a new
+    address and VID:PID. So only that port is looked at, rather than
+    rescanning everything and guessing from the board type. The firmware
+    decides what type the board claims to be when it comes back, so a
+    board which comes back as a different type is in the wrong state.
+    """
+    import argparse
+    port_args = argparse.Namespace(**vars(args))
+    port_args.by_position = old_board.position
+    port_args.by_type = None
+
+    with TRACE.span("wait_for_board", board=old_board.position, type=old_board.type,
+                    old_state=old_board.state, new_state=newmode) as span:
+        starttime = time.time()
+        polls = 0
+        while True:
+            polls += 1
+            span.set(polls=polls)
+
+            for new_board in find_hdmi2usb_boards(port_args):
+                if args.verbose:
+                    sys.stderr.write("%s %s\n" % (new_board, old_board))
+                if new_board.dev.path == old_board.dev.path:
+                    # Not re-enumerated yet.
+                    continue
+                if new_board.type != old_board.type:
+                    raise SwitchWrongState("%s came back as %s in %s mode rather than %s" % (
+                        old_board.position, new_board.type, new_board.state, old_board.type))
+                if new_board.state == old_board.state and old_board.state != newmode:
+                    continue
+                if new_board.state != newmode:
+                    raise SwitchWrongState("%s came back in %s mode rather than %s" % (
+                        old_board.position, new_board.state, newmode))
+                return new_board
+
+            remaining = None
+            if timeout:
+                remaining = starttime + timeout - time.time()
+                if remaining <= 0:
+                    raise SwitchTimeout("Timeout!")
+
+            events.wait(remaining)
+
+
+def open_serial(path, baudrate=115200):
+    """Open a tty in raw mode, returning the file descriptor."""
+    import termios
+    import tty
+
+    fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    try:
+        tty.setraw(fd)
+        attrs = termios.tcgetattr(fd)
+        speed = getattr(termios, "B%i" % baudrate)
+        attrs[4] = attrs[5] = speed
+        # Ignore modem control lines, enable the receiver.
+        attrs[2] |= termios.CLOCAL | termios.CREAD
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+        termios.tcflush(fd, termios.TCIOFLUSH)
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+
+def serial_read(fd, timeout):
+    """Read whatever is available on fd, waiting up to timeout for it."""
+    import select
+    readable, _, _ = select.select([fd], [], [], max(timeout, 0))
+    if not readable:
+        return ""
+    try:
+        return os.read(fd, 4096)
+    except OSError:
+        return ""
+
+
+Identity = namedtuple("Identity", ["dna", "mac"])
+
+DNA_REGEX = re.compile(r"DNA:?\s*(?:0x)?(?P<dna>[0-9a-fA-F]{14,16})\b")
+MAC_REGEX = re.compile(r"MAC:?\s*(?P<mac>[0-9a-fA-F]{2}(?:[:-][0-9a-fA-F]{2}){5})\b")
+
+def normalise_dna(dna):
+    dna = dna.lower()
+    if dna.startswith("0x"):
+        dna = dna[2:]
+    return dna.lstrip("0")
+
+
+def normalise_mac(mac):
+    return mac.lower().replace("-", ":")
+
+
+def probe_board_identity(board, timeout=2.0):
+    """Ask the firmware on the board for its FPGA DNA and MAC address.
+
+    Sends the version command to the firmware console on the board's serial
+    port and picks the "DNA: ..." and "MAC: ..." lines out of the reply.
+    """
+    ttys = board.tty()
+    if board.state != "operational" or not ttys:
+        raise SystemError("Can only probe %s in operational mode with a serial port (%s, %s)" % (
+            board.position, board.state, ttys))
+
+    with TRACE.span("probe_board_identity", board=board.position, tty=ttys[0]) as span:
+        fd = open_serial(ttys[0])
+        try:
+            os.write(fd, "\r\nversion\r\n")
+            output = ""
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                output += serial_read(fd, deadline - time.time())
+                dna = DNA_REGEX.search(output)
+                mac = MAC_REGEX.search(output)
+                if dna and mac:
+                    break
+        finally:
+            os.close(fd)
+
+        if not dna:
+            raise SystemError("Board at %s didn't report its DNA." % board.position)
+        identity = Identity(
+            dna=normalise_dna(dna.group("dna")),
+            mac=mac and normalise_mac(mac.group("mac")))
+        span.set(dna=identity.dna, mac=identity.mac)
+        return identity
+
+
+class PositionCache(object):
+    """Persistent map from where a board is plugged in to what we know about it.
+
+    Entries are keyed on the board's position and record its USB identity
+    when they were stored; if a different device is found at that position
+    the entry no longer applies. The file is shared between concurrent runs
+    using flock() on a lock file, and replaced atomically on update.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def _lock(self, operation):
+        import fcntl
+
+        dirname = os.path.dirname(self.filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        lockfile = open(self.filename + ".lock", "a")
+        fcntl.flock(lockfile.fileno(), operation)
+        return lockfile
+
+    def _read(self):
+        import json
+        try:
+            return json.load(open(self.filename, "r"))
+        except (EnvironmentError, ValueError):
+            return {}
+
+    @staticmethod
+    def _usb_id(board):
+        return [board.dev.vid, board.dev.pid, board.dev.serialno]
+
+    def get_entry(self, board):
+        import fcntl
+
+        lockfile = self._lock(fcntl.LOCK_SH)
+        try:
+            entry = self._read().get(board.position)
+        finally:
+            lockfile.close()
+
+        if not entry or entry["usb_id"] != self._usb_id(board):
+            return None
+        return entry
+
+    def put_entry(self, board, **values):
+        import fcntl
+        import json
+        import tempfile
+
+        lockfile = self._lock(fcntl.LOCK_EX)
+        try:
+            entries = self._read()
+            entries[board.position] = dict(values, usb_id=self._usb_id(board))
+            fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(self.filename))
+            with os.fdopen(fd, "w") as f:
+                json.dump(entries, f, indent=4, sort_keys=True, separators=(",", ": "))
+            os.rename(tmpname, self.filename)
+        finally:
+            lockfile.close()
+
+
+class IdentityCache(PositionCache):
+    """The DNA and MAC of the board at each position.
+
+    The USB identity is the vid, pid and serial number, which doesn't change
+    when the board is switched back into the same mode.
+    """
+
+    def __init__(self, filename=os.path.join(CACHE_DIR, "identity.json")):
+        PositionCache.__init__(self, filename)
+
+    def get(self, board):
+        entry = self.get_entry(board)
+        if entry is None:
+            return None
+        return Identity(dna=entry["dna"], mac=entry["mac"])
+
+    def put(self, board, identity):
+        self.put_entry(board, dna=identity.dna, mac=identity.mac, probed=time.time())
+
+    def lookup(self, board, probe=True):
+        """Get the identity of a board, probing it (and caching the result)
+        if it isn't already known. Returns None if it can't be found."""
+        identity = self.get(board)
+        if identity is None and probe:
+            try:
+                identity = probe_board_identity(board)
+            except (SystemError, EnvironmentError) as e:
+                logging.info("Unable to probe %s: %s", board.position, e)
+                return None
+            self.put(board, identity)
+        return identity
+
+IDENTITY_CACHE = IdentityCache()
+
+
+def filter_boards_by_identity(args, boards, cache=IDENTITY_CACHE, probe=True):
+    """Apply --by-dna and --by-mac.
+
+    Without probe only the cache is used (so no board's console is touched),
+    and boards whose identity isn't known yet are kept as they might match.
+    """
+    if not (args.by_dna or args.by_mac):
+        return boards
+
+    filtered_boards = []
+    for board in boards:
+        identity = cache.lookup(board, probe=probe)
+        if identity is None and not probe:
+            filtered_boards.append(board)
+            continue
+        if identity is None:
+            if args.verbose:
+                sys.stderr.write("%s at %s has unknown DNA/MAC\n" % (board.type, board.position))
+            continue
+        if args.by_dna and normalise_dna(args.by_dna) != identity.dna:
+            continue
+        if args.by_mac and normalise_mac(args.by_mac) != identity.mac:
+            continue
+        filtered_boards.append(board)
+    return filtered_boards
+
+
+class FirmwareStateCache(PositionCache):
+    """The firmware we last loaded onto the board at each position.
+
+    The USB identity includes the bus and device number, which change every
+    time the board re-enumerates, so an entry only applies while the board
+    is still running the firmware we loaded.
+    """
+
+    def __init__(self, filename=os.path.join(CACHE_DIR, "firmware-state.json")):
+        PositionCache.__init__(self, filename)
+
+    @staticmethod
+    def _usb_id(board):
+        return [board.dev.path.bus, board.dev.path.address,
+                board.dev.vid, board.dev.pid, board.dev.serialno]
+
+    def get(self, board):
+        """sha256 of the firmware the board is running, None if unknown."""
+        entry = self.get_entry(board)
+        return entry and entry["sha256"]
+
+    def put(self, board, image):
+        self.put_entry(board, sha256=image.sha256,
+                       firmware=os.path.relpath(image.filename, TOPDIR), loaded=time.time())
+
+FIRMWARE_STATE = FirmwareStateCache()
 
-    subprocess.check_call(cmdline)
+
+def board_runs_firmware(board, filename, cache=FIRMWARE_STATE):
+    """Work out if the board is already running the firmware in filename.
+
+    If we loaded the firmware the board is running the sha256s are compared,
+    otherwise the board's descriptors are compared with the ones in the
+    firmware (vid, pid, bcdDevice and serial number). Returns None if it
+    can't be told either way.
+    """
+    image = load_firmware_image(os.path.abspath(filename))
+    sha256 = cache.get(board)
+    if sha256:
+        return sha256 == image.sha256
+
+    descriptor = firmware_descriptor(image.segments)
+    if descriptor is None:
+        return None
+    if (board.dev.vid, board.dev.pid) != (descriptor.vid, descriptor.pid):
+        return False
+    if board.dev.serialno and board.dev.serialno not in descriptor.strings:
+        return False
+    bcd = read_sysfs_attr(board.dev.syspaths[0], "bcdDevice")
+    if bcd is None:
+        return None
+    return int(bcd, 16) == descriptor.bcd
+
+
+# The serial boot protocol spoken by the lm32 BIOS (the same one flterm uses).
+# The BIOS sends SFL_MAGIC_REQ when it starts a serial boot, the host answers
+# with SFL_MAGIC_ACK and then sends frames of
+#   length (1 byte), crc16 (2 bytes, big endian), cmd (1 byte), payload
+# each of which the BIOS acknowledges with a single byte.
+SFL_MAGIC_REQ = "sL5DdSMmkekro\n"
+SFL_MAGIC_ACK = "z6IHG7cYDID6o\n"
+
+SFL_CMD_ABORT = 0x00
+SFL_CMD_LOAD = 0x01
+SFL_CMD_JUMP = 0x02
+
+SFL_ACK_SUCCESS = "K"
+SFL_ACK_CRCERROR = "C"
+SFL_ACK_UNKNOWN = "U"
+SFL_ACK_ERROR = "E"
+
+SFL_MAX_PAYLOAD = 255
+# Each load frame carries a 4 byte address.
+SFL_MAX_DATA = SFL_MAX_PAYLOAD - 4
+
+LM32_LOAD_ADDRESS = 0x40000000
+
+
+def _crc16_table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xffff
+            else:
+                crc = (crc << 1) & 0xffff
+        table.append(crc)
+    return table
+
+CRC16_TABLE = _crc16_table()
+
+def crc16(data):
+    """CRC-16/XMODEM (CCITT polynomial, zero initial value) of data."""
+    crc = 0
+    for byte in bytearray(data):
+        crc = ((crc << 8) & 0xffff) ^ CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+
+def sfl_frame(cmd, payload=""):
+    assert len(payload) <= SFL_MAX_PAYLOAD, len(payload)
+    crc = crc16(chr(cmd) + payload)
+    return chr(len(payload)) + chr(crc >> 8) + chr(crc & 0xff) + chr(cmd) + payload
+
+
+def sfl_address(address):
+    return "".join(chr((address >> shift) & 0xff) for shift in (24, 16, 8, 0))
+
+
+class Lm32UploadError(IOError):
+    """Upload failed, offset is how much of the image was acknowledged and
+    resent how many frames had been resent before it did."""
+    def __init__(self, message, offset=0, resent=0):
+        IOError.__init__(self, message)
+        self.offset = offset
+        self.resent = resent
+
+
+def _write_all(fd, data):
+    import select
+    while data:
+        try:
+            written = os.write(fd, data)
+        except OSError as e:
+            import errno
+            if e.errno != errno.EAGAIN:
+                raise
+            written = 0
+        data = data[written:]
+        if data:
+            select.select([], [fd], [], 1.0)
+
+
+def sfl_handshake(fd, timeout=10.0):
+    """Start the BIOS serial boot and wait for it to ask for an image."""
+    _write_all(fd, "\r\nserialboot\r\n")
+    output = ""
+    deadline = time.time() + timeout
+    while SFL_MAGIC_REQ not in output:
+        if time.time() > deadline:
+            raise Lm32UploadError("No serial boot request from the BIOS after %ss" % timeout)
+        output += serial_read(fd, deadline - time.time())
+    _write_all(fd, SFL_MAGIC_ACK)
+
+
+def sfl_upload(fd, data, address=LM32_LOAD_ADDRESS, offset=0, window=8, retries=8, timeout=1.0, stalls=2):
+    """Send data to the BIOS, keeping up to window frames in flight.
+
+    Acknowledgements come back in order. On a CRC error or a timeout
+    everything from the first unacknowledged frame is resent (load frames
+    are idempotent, so resending a frame which did land is harmless). The
+    upload starts at offset so an interrupted upload can be resumed. After
+    stalls timeouts in a row the BIOS has probably given up on the upload,
+    so this does too (rather than waiting for all the retries) and lets the
+    caller start another serial boot.
+
+    Returns the number of frames which had to be resent.
+    """
+    frames = []
+    for start in range(offset - offset % SFL_MAX_DATA, len(data), SFL_MAX_DATA):
+        chunk = data[start:start+SFL_MAX_DATA]
+        frames.append((start, sfl_frame(SFL_CMD_LOAD, sfl_address(address + start) + chunk)))
+
+    acked = 0
+    sent = 0
+    ignore = 0
+    resent = 0
+    failures = 0
+    timeouts = 0
+    pending = ""
+    while acked < len(frames):
+        while sent < len(frames) and sent - acked < window:
+            _write_all(fd, frames[sent][1])
+            sent += 1
+
+        if not pending:
+            pending = serial_read(fd, timeout)
+        if not pending:
+            # Lost frames or lost acks, either way nothing more is coming.
+            failures += 1
+            timeouts += 1
+            if failures > retries or timeouts >= stalls:
+                raise Lm32UploadError("Timeout waiting for acknowledgement", frames[acked][0], resent)
+            while serial_read(fd, 0.1):
+                pass
+            resent += sent - acked
+            sent = acked
+            ignore = 0
+            continue
+
+        ack, pending = pending[0], pending[1:]
+        timeouts = 0
+        if ignore:
+            ignore -= 1
+            continue
+        if ack == SFL_ACK_SUCCESS:
+            acked += 1
+            continue
+        if ack == SFL_ACK_CRCERROR:
+            failures += 1
+            if failures > retries:
+                raise Lm32UploadError("Too many CRC errors", frames[acked][0], resent)
+            # The frames already behind the bad one will still be answered.
+            ignore = sent - acked - 1
+            resent += sent - acked
+            sent = acked
+            continue
+        raise Lm32UploadError("BIOS rejected load frame (%r)" % ack, frames[acked][0], resent)
+    return resent
+
+
+def sfl_jump(fd, address=LM32_LOAD_ADDRESS, timeout=1.0):
+    _write_all(fd, sfl_frame(SFL_CMD_JUMP, sfl_address(address)))
+    ack = serial_read(fd, timeout)[:1]
+    if ack != SFL_ACK_SUCCESS:
+        raise Lm32UploadError("BIOS didn't accept jump to 0x%08x (%r)" % (address, ack))
+
+
+Lm32UploadResult = namedtuple("Lm32UploadResult", ["size", "secs", "resent", "attempts"])
+
+def upload_lm32_firmware(path, filename, address=LM32_LOAD_ADDRESS, attempts=3, window=8, baudrate=115200):
+    """Upload filename to the lm32 BIOS on the serial port at path and boot it.
+
+    If an attempt fails part way the BIOS is asked to serial boot again and
+    the upload resumes from the last acknowledged frame.
+    """
+    data = open(filename, "rb").read()
+    with TRACE.span("upload_lm32_firmware", tty=path, size=len(data)) as span:
+        starttime = time.time()
+        fd = open_serial(path, baudrate)
+        try:
+            offset = 0
+            resent = 0
+            for attempt in range(1, attempts+1):
+                try:
+                    sfl_handshake(fd)
+                    resent += sfl_upload(fd, data, address, offset=offset, window=window)
+                    sfl_jump(fd, address)
+                    break
+                except Lm32UploadError as e:
+                    resent += e.resent
+                    if attempt == attempts:
+                        raise
+                    logging.warning("Upload to %s failed at 0x%x (%s), retrying", path, e.offset, e)
+                    offset = max(offset, e.offset)
+        finally:
+            os.close(fd)
+        result = Lm32UploadResult(len(data), time.time() - starttime, resent, attempt)
+        span.set(resent=resent, attempts=attempt)
+        return result
+
+
+def board_to_dict(board):
+    """Snapshot everything known about a board into plain data."""
+    return {
+        "type": board.type,
+        "state": board.state,
+        "usbfs": board.dev.path.path,
+        "bus": board.dev.path.bus,
+        "address": board.dev.path.address,
+        "vid": board.dev.vid,
+        "pid": board.dev.pid,
+        "serialno": board.dev.serialno,
+        "syspaths": list(board.dev.syspaths),
+        "position": board.position,
+        "drivers": list(board.dev.drivers()),
+        "tty": list(board.tty()),
+        "video": list(board.video()),
+        }
+
+
+def board_from_dict(data):
+    class SnapshotDevice(Device):
+        def __new__(cls, syspaths, drivers, tty, video, **kw):
+            self = Device.__new__(cls, **kw)
+            self.syspaths = syspaths
+            self._drivers = tuple(drivers)
+            self._tty = list(tty)
+            self._video = list(video)
+            return self
+
+        def inuse(self):
+            return bool(self._drivers)
+
+        def drivers(self):
+            return self._drivers
+
+        def tty(self):
+            return list(self._tty)
+
+        def video(self):
+            return list(self._video)
+
+    def s(v):
+        return v if v is None else str(v)
+
+    dev = SnapshotDevice(
+        path=Path(bus=data["bus"], address=data["address"]),
+        vid=data["vid"],
+        pid=data["pid"],
+        serialno=s(data["serialno"]),
+        syspaths=[str(p) for p in data["syspaths"]],
+        drivers=[str(d) for d in data["drivers"]],
+        tty=[str(t) for t in data["tty"]],
+        video=[str(v) for v in data.get("video", [])],
+        )
+    return Board(dev=dev, type=str(data["type"]), state=str(data["state"]))
+
+
+# Shared between all users on the host, so not in XDG_RUNTIME_DIR.
+LOCK_DIR = os.environ.get("HDMI2USB_LOCK_DIR", "/tmp/hdmi2usb-mode-switch-locks")
+# Positions of the boards a parent process has already locked for us.
+HELD_POSITIONS = [p for p in os.environ.get("HDMI2USB_LOCKED", "").split(os.pathsep) if p]
+
+
+class BoardsBusy(SystemError):
+    pass
+
+
+def open_lock_file(lock_dir, name):
+    """Open (creating) a lock file which every user can lock."""
+    if not os.path.isdir(lock_dir):
+        try:
+            os.makedirs(lock_dir)
+            os.chmod(lock_dir, 01777)
+        except OSError:
+            if not os.path.isdir(lock_dir):
+                raise
+    import errno
+    import stat
+
+    # The directory is world writable, so don't follow a link someone else
+    # left there to a file of their choosing (or open a fifo or device).
+    path = os.path.join(lock_dir, name)
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0666)
+    except OSError as e:
+        if e.errno != errno.ELOOP:
+            raise
+        raise SystemError("Lock file %s is a symlink, refusing to use it." % path)
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        os.close(fd)
+        raise SystemError("Lock file %s is not a regular file, refusing to use it." % path)
+    try:
+        os.fchmod(fd, 0666)
+    except OSError:
+        pass
+    return fd
+
+
+def pid_alive(pid):
+    import errno
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class BoardLock(object):
+    """Advisory lock on the board plugged into a position.
+
+    The position is the key as it stays the same when the board is switched
+    between modes (unlike the vid, pid and serial number). The lock is an
+    flock() so it goes away with the process holding it; the file also
+    records who holds it.
+    """
+
+    def __init__(self, position, lock_dir=LOCK_DIR):
+        self.position = position
+        self.lock_dir = lock_dir
+        self.fd = None
+
+    def try_acquire(self):
+        import fcntl
+        import json
+
+        fd = open_lock_file(self.lock_dir, "%s.lock" % self.position)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, json.dumps({"pid": os.getpid(), "cmd": sys.argv, "since": time.time()}))
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            os.ftruncate(self.fd, 0)
+            os.close(self.fd)
+            self.fd = None
+
+    def holder(self):
+        """Who holds the lock (as recorded in the file), None if unknown."""
+        import json
+        try:
+            return json.load(open(os.path.join(self.lock_dir, "%s.lock" % self.position)))
+        except (EnvironmentError, ValueError):
+            return None
+
+
+class BoardScheduler(object):
+    """Hands out locked boards to concurrent invocations in the order they asked.
+
+    Waiters are kept in a queue file (entries of dead processes are dropped).
+    A waiter can only take a free board if no waiter ahead of it in the
+    queue also wants that board, so a job waiting for a particular board or
+    for all boards isn't starved by jobs taking any free one. How long each
+    reservation waited is appended to a log for lock_stats().
+    """
+
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, lock_dir=LOCK_DIR, held=HELD_POSITIONS):
+        self.lock_dir = lock_dir
+        self.held = set(held)
+
+    def _queue(self, update):
+        """Call update(entries) with the queue locked, saving the result."""
+        import fcntl
+        import json
+
+        fd = open_lock_file(self.lock_dir, "queue")
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            f = os.fdopen(os.dup(fd), "r+")
+            try:
+                try:
+                    entries = json.loads(f.read() or "[]")
+                except ValueError:
+                    entries = []
+                entries = [e for e in entries if pid_alive(e["pid"])]
+                result = update(entries)
+                f.seek(0)
+                f.truncate()
+                json.dump(entries, f)
+            finally:
+                f.close()
+        finally:
+            os.close(fd)
+        return result
+
+    @staticmethod
+    def _wants(entry, board):
+        return all(entry[k] in (None, v) for k, v in (
+            ("type", board.type), ("state", board.state), ("position", board.position)))
+
+    def reserve(self, find_boards, count=None, timeout=None, type=None, state=None, position=None, check=None,
+                output=sys.stderr):
+        """Lock count of the boards returned by find_boards(), or all of them if count is None.
+
+        find_boards is called again every poll as boards come and go or
+        change state. Boards already held by a parent process are used
+        without locking. If given, check(boards) is called once boards are
+        locked and returns those which are really wanted, the rest are
+        unlocked and not tried again. Who holds the boards is written to
+        output when it first has to wait. Returns a list of (board, BoardLock
+        or None) and raises BoardsBusy if timeout runs out first.
+        """
+        ticket = "%s-%s" % (os.getpid(), time.time())
+        me = {"ticket": ticket, "pid": os.getpid(), "since": time.time(),
+              "type": type, "state": state, "position": position}
+        self._queue(lambda entries: entries.append(me))
+
+        starttime = time.time()
+        rejected = set()
+        waiting = False
+        try:
+            with TRACE.span("reserve_boards", type=type, state=state, position=position) as span:
+                while True:
+                    boards = [b for b in find_boards() if b.position not in rejected]
+                    wanted = [count, len(boards)][count is None]
+                    locked = self._queue(lambda entries: self._try_lock(entries, ticket, boards, wanted))
+                    if locked is not None and check is not None:
+                        accepted = set(b.position for b in check([b for b, _ in locked]))
+                        if len(accepted) < len(locked):
+                            for board, lock in locked:
+                                if board.position not in accepted:
+                                    rejected.add(board.position)
+                                if lock:
+                                    lock.release()
+                            # Try again straight away without them.
+                            continue
+                    if locked is not None:
+                        waited = time.time() - starttime
+                        span.set(waited=waited, boards=[b.position for b, _ in locked])
+                        self._log(waited, locked, type, state)
+                        return locked
+
+                    if timeout is not None and time.time() - starttime > timeout:
+                        raise BoardsBusy("No free boards after %.1fs, busy: %s" % (
+                            timeout, self._holders(boards)))
+                    if not waiting:
+                        waiting = True
+                        output.write("Waiting for boards, busy: %s\n" % self._holders(boards))
+                        output.flush()
+                    time.sleep(self.POLL_INTERVAL)
+        finally:
+            def dequeue(entries):
+                entries[:] = [e for e in entries if e["ticket"] != ticket]
+            self._queue(dequeue)
+
+    def _holders(self, boards):
+        holders = []
+        for board in boards:
+            holder = BoardLock(board.position, self.lock_dir).holder() or {}
+            holders.append("%s (pid %s%s)" % (
+                board.position, holder.get("pid", "?"),
+                ", %s" % " ".join(holder["cmd"]) if holder.get("cmd") else ""))
+        return ", ".join(holders) or "none found"
+
+    def _try_lock(self, entries, ticket, boards, wanted):
+        ahead = []
+        for entry in entries:
+            if entry["ticket"] == ticket:
+                break
+            ahead.append(entry)
+
+        locked = []
+        for board in boards:
+            if len(locked) == wanted:
+                break
+            if board.position in self.held:
+                locked.append((board, None))
+                continue
+            if any(self._wants(entry, board) for entry in ahead):
+                continue
+            lock = BoardLock(board.position, self.lock_dir)
+            if lock.try_acquire():
+                locked.append((board, lock))
+
+        if len(locked) < wanted:
+            # Don't sit on some of the boards while waiting for the rest.
+            for _, lock in locked:
+                if lock:
+                    lock.release()
+            return None
+        return locked
+
+    def _log(self, waited, locked, type, state):
+        import fcntl
+        import json
+
+        fd = open_lock_file(self.lock_dir, "waits.jsonl")
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.lseek(fd, 0, os.SEEK_END)
+            os.write(fd, json.dumps({
+                "time": time.time(), "waited": waited, "pid": os.getpid(),
+                "type": type, "state": state, "boards": [b.position for b, _ in locked],
+                }) + "\n")
+        finally:
+            os.close(fd)
+
+    def stats(self, since=None):
+        """Wait time statistics from the log, as a dictionary."""
+        import json
+
+        waits = []
+        try:
+            lines = open(os.path.join(self.lock_dir, "waits.jsonl")).readlines()
+        except EnvironmentError:
+            lines = []
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if since is None or entry["time"] >= since:
+                waits.append(entry["waited"])
+
+        waits.sort()
+        if not waits:
+            return {"count": 0}
+        return {
+            "count": len(waits),
+            "mean": sum(waits) / len(waits),
+            "median": waits[len(waits) // 2],
+            "p95": waits[min(len(waits) - 1, int(len(waits) * 0.95))],
+            "max": waits[-1],
+            "queued": len([w for w in waits if w >= self.POLL_INTERVAL]),
+            }
+
+BOARD_SCHEDULER = BoardScheduler()
+
+
+DAEMON_SOCKET = os.environ.get("HDMI2USB_DAEMON_SOCKET", os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR", "/tmp"),
+    "hdmi2usb-mode-switch-%s.sock" % os.getuid()))
+
+def query_daemon(request, socket_path=DAEMON_SOCKET, timeout=5.0):
+    """Send a request to the inventory daemon.
+
+    Returns the decoded response, or None if the daemon isn't running (or
+    doesn't answer properly within timeout).
+    """
+    import json
+    import socket
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request) + "\n")
+        response = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            response.append(data)
+        response = json.loads("".join(response))
+    except (EnvironmentError, ValueError) as e:
+        logging.info("No answer from the daemon on %s: %s", socket_path, e)
+        return None
+    finally:
+        sock.close()
+    if not isinstance(response, dict):
+        logging.info("Bad answer from the daemon on %s: %r", socket_path, response)
+        return None
+    if "error" in response:
+        raise SystemError("Daemon error: %s" % response["error"])
+    return response
+
+
+def rescan_daemon(socket_path=DAEMON_SOCKET):
+    """Make the inventory daemon (if one is running) rescan now.
+
+    Used after switching boards, so the daemon doesn't answer the next query
+    from before the switch if it hasn't seen the USB events yet.
+    """
+    try:
+        query_daemon({"rescan": True}, socket_path)
+    except SystemError as e:
+        logging.warning("Inventory daemon didn't rescan: %s", e)
+
+
+class InventoryDaemon(object):
+    """Keeps the board inventory up to date and answers queries about it.
+
+    The inventory is rescanned when a USB or tty device is added, removed,
+    bound or unbound (and every rescan interval in case an event was
+    missed), so queries are answered straight from the last snapshot.
+
+    Requests are a single line of JSON, either
+     {"boards": true, "by_type": <type or null>, "by_position": <position or null>}
+    which returns {"scantime": <time>, "boards": [<board_to_dict>, ...]}, or
+     {"rescan": true}
+    which rescans before answering in the same way.
+    """
+
+    RESCAN_INTERVAL = 10.0
+
+    def __init__(self, args, socket_path=DAEMON_SOCKET):
+        import argparse
+        # Scan for every board quietly, requests do their own filtering.
+        self.scan_args = argparse.Namespace(**vars(args))
+        self.scan_args.by_type = None
+        self.scan_args.verbose = 0
+
+        self.verbose = args.verbose
+        self.socket_path = socket_path
+        self.boards = []
+        # When the inventory was last scanned, and last tried to be scanned.
+        self.scantime = 0
+        self.attempttime = 0
+
+    def rescan(self):
+        self.attempttime = time.time()
+        try:
+            boards = [board_to_dict(b) for b in find_hdmi2usb_boards(self.scan_args)]
+        except Exception:
+            # Devices coming and going mid scan (like a driver unbinding)
+            # can upset it, the next event or interval will try again.
+            logging.exception("Rescan failed, keeping the inventory from %s", time.ctime(self.scantime))
+            return
+        self.boards = boards
+        self.scantime = self.attempttime
+        if self.verbose:
+            sys.stderr.write("Inventory has %s boards.\n" % len(self.boards))
+
+    def handle(self, request):
+        if not isinstance(request, dict) or not (request.get("boards") or request.get("rescan")):
+            return {"error": "Unknown request %r" % (request,)}
+        if request.get("rescan"):
+            self.rescan()
+        by_type = request.get("by_type")
+        by_position = request.get("by_position")
+        return {
+            "scantime": self.scantime,
+            "boards": [b for b in self.boards
+                if (not by_type or b["type"] == by_type) and
+                   (not by_position or b["position"] == by_position)],
+            }
+
+    def serve_one(self, conn):
+        import json
+        conn.settimeout(5.0)
+        try:
+            request = conn.makefile("r").readline()
+            try:
+                response = self.handle(json.loads(request))
+            except ValueError as e:
+                response = {"error": str(e)}
+            except Exception as e:
+                logging.exception("Failed to handle %r", request)
+                response = {"error": "%s: %s" % (type(e).__name__, e)}
+            conn.sendall(json.dumps(response))
+        except EnvironmentError as e:
+            logging.info("Dropping client: %s", e)
+        finally:
+            conn.close()
+
+    def listen(self):
+        import socket
+
+        # Clean up after a daemon which didn't exit cleanly (one which is
+        # running still accepts connections, even if it's too busy to answer).
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except EnvironmentError:
+                os.unlink(self.socket_path)
+            else:
+                raise SystemError("Daemon already running on %s" % self.socket_path)
+            finally:
+                probe.close()
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socket_path)
+        sock.listen(16)
+        return sock
+
+    def run(self):
+        import select
+        import signal
+
+        # Make sure the socket gets cleaned up.
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+        sock = self.listen()
+        events = UsbEventWaiter(subsystems=("usb", "tty"))
+        try:
+            self.rescan()
+            while True:
+                watch = [sock]
+                if events.sock is not None:
+                    watch.append(events.sock)
+                timeout = max(0, self.attempttime + self.RESCAN_INTERVAL - time.time())
+                readable, _, _ = select.select(watch, [], [], timeout)
+
+                if not readable or (events.sock in readable and events._drain()):
+                    self.rescan()
+
+                if sock in readable:
+                    conn, _ = sock.accept()
+                    self.serve_one(conn)
+        finally:
+            events.close()
+            sock.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+
+# Where capture_usb_host() looks, relative to the host's root directory.
+CAPTURE_DIRS = [
+    "sys/bus/usb/devices",
+    "sys/class/tty",
+    "sys/class/video4linux",
+    "dev/bus/usb",
+    ]
+# Subdirectories of a device or interface which are captured (with the
+# attributes of their children), anything else is skipped.
+CAPTURE_SUBDIRS = re.compile(r"^(tty|video4linux|ttyUSB[0-9]+)$")
+CAPTURE_MAX_ATTR = 4096
+
+def capture_usb_host(filename, root=None, lsusb=True):
+    """Save the USB state of a host into a .tar.gz for later replay.
+
+    Captures the /sys/bus/usb/devices entries and the small attribute files
+    of the devices and interfaces they point to, the USB entries in
+    /sys/class/tty and /sys/class/video4linux, the /dev/bus/usb nodes (as
+    empty files) and the output of lsusb. Symlinks are stored relative so
+    the archive can be unpacked anywhere.
+
+    Returns the number of archive members.
+    """
+    import StringIO
+    import json
+    import socket
+    import tarfile
+
+    root = root or host_root()
+    members = {}
+
+    def arcname(path):
+        return os.path.relpath(os.path.realpath(path), os.path.realpath(root))
+
+    def add(name, type=tarfile.DIRTYPE, data="", linkname=""):
+        if name in members or name.startswith(".."):
+            return
+        # Parent directories first
+        parent = os.path.dirname(name)
+        if parent:
+            add(parent)
+        info = tarfile.TarInfo(name)
+        info.type = type
+        info.mtime = time.time()
+        info.mode = [0755, 0644][type == tarfile.REGTYPE]
+        info.size = len(data)
+        info.linkname = linkname
+        members[name] = (info, data)
+
+    def add_link(path):
+        name = os.path.join(arcname(os.path.dirname(path)), os.path.basename(path))
+        target = arcname(path)
+        add(name, tarfile.SYMTYPE, linkname=os.path.relpath(target, os.path.dirname(name)))
+        return target
+
+    def add_attrs(path):
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return
+        add(arcname(path))
+        for name in names:
+            filepath = os.path.join(path, name)
+            if os.path.islink(filepath):
+                if name == "driver":
+                    add(arcname(filepath))
+                    add_link(filepath)
+            elif os.path.isdir(filepath):
+                if CAPTURE_SUBDIRS.match(name):
+                    for child in os.listdir(filepath):
+                        add_attrs(os.path.join(filepath, child))
+            elif os.path.isfile(filepath) and name != "descriptors":
+                try:
+                    with open(filepath, "rb") as f:
+                        data = f.read(CAPTURE_MAX_ATTR + 1)
+                except EnvironmentError:
+                    continue
+                if len(data) <= CAPTURE_MAX_ATTR:
+                    add(os.path.join(arcname(path), name), tarfile.REGTYPE, data)
+
+    sys_root, class_tty, class_video, dev_root = [os.path.join(root, d) for d in CAPTURE_DIRS]
+    add(CAPTURE_DIRS[0])
+    usb_dirs = []
+    for name in sorted(os.listdir(sys_root)):
+        usb_dirs.append(add_link(os.path.join(sys_root, name)))
+        add_attrs(os.path.join(sys_root, name))
+
+    for class_root in (class_tty, class_video):
+        if not os.path.isdir(class_root):
+            continue
+        for name in sorted(os.listdir(class_root)):
+            target = arcname(os.path.join(class_root, name))
+            # Only the ones which belong to a USB device
+            if any(target.startswith(d + "/") for d in usb_dirs):
+                add_link(os.path.join(class_root, name))
+
+    for dirpath, dirnames, filenames in os.walk(dev_root):
+        for name in filenames:
+            add(os.path.relpath(os.path.join(dirpath, name), root), tarfile.REGTYPE)
+
+    if lsusb:
+        try:
+            add("lsusb.txt", tarfile.REGTYPE, subprocess.check_output("lsusb"))
+        except (EnvironmentError, subprocess.CalledProcessError) as e:
+            logging.warning("Not capturing lsusb output: %s", e)
+
+    add("capture.json", tarfile.REGTYPE, json.dumps({
+        "hostname": socket.gethostname(),
+        "uname": list(os.uname()),
+        "time": time.time(),
+        "root": root,
+        }, indent=4, sort_keys=True, separators=(",", ": ")))
+
+    with tarfile.open(filename, "w:gz") as archive:
+        for name in sorted(members):
+            info, data = members[name]
+            archive.addfile(info, StringIO.StringIO(data))
+    return len(members)
+
+
+def replay_usb_host(filename, root):
+    """Unpack a capture_usb_host() archive into root.
+
+    Returns (sys_root, dev_root, lsusb file or None).
+    """
+    import tarfile
+
+    with tarfile.open(filename, "r:*") as archive:
+        members = archive.getmembers()
+        symlinks = set(os.path.normpath(m.name) for m in members if m.issym())
+        for member in members:
+            name = os.path.normpath(member.name)
+            target = name
+            if member.issym():
+                target = os.path.normpath(os.path.join(os.path.dirname(name), member.linkname))
+            if os.path.isabs(target) or target.split(os.sep)[0] == "..":
+                raise SystemError("%s: %s points outside the capture" % (filename, member.name))
+            if not (member.isdir() or member.isfile() or member.issym()):
+                raise SystemError("%s: %s isn't a file, directory or symlink" % (filename, member.name))
+            # Nothing may be written through a symlink, which could lead anywhere.
+            parent = os.path.dirname(name)
+            while parent:
+                if parent in symlinks:
+                    raise SystemError("%s: %s is under the symlink %s" % (filename, member.name, parent))
+                parent = os.path.dirname(parent)
+        archive.extractall(root, members)
+
+    # A symlink's target can go through other symlinks, so check where they
+    # really lead now they are all there.
+    realroot = os.path.realpath(root)
+    for member in members:
+        path = os.path.realpath(os.path.join(root, member.name))
+        if path != realroot and not path.startswith(realroot + os.sep):
+            raise SystemError("%s: %s points outside the capture" % (filename, member.name))
+
+    sys_root, _, _, dev_root = [os.path.join(root, d) for d in CAPTURE_DIRS]
+    lsusb = os.path.join(root, "lsusb.txt")
+    return sys_root, dev_root, [None, lsusb][os.path.exists(lsusb)]
+
+
+def load_testing():
+    """Load the fakes, mocks, tests and benchmarks in hdmi2usb_testing.py.
+
+    They are only needed for testing and benchmarking, so are kept out of
+    this script which Python has to compile every time it runs.
+    """
+    import imp
+    testing = imp.load_source("hdmi2usb_testing", os.path.join(TOPDIR, "hdmi2usb_testing.py"))
+    testing.ms = sys.modules[__name__]
+    return testing
 
 
 # Parse the command line name
@@ -295,7 +2953,7 @@ if cmd.endswith('.py'):
 
 BOARD, MODE = cmd.split('-', 1)
 assert_in(BOARD, BOARD_TYPES+['hdmi2usb'])
-POSSIBLE_MODES = ['find-board', 'mode-switch']
+POSSIBLE_MODES = ['find-board', 'mode-switch', 'daemon', 'benchmark', 'capture', 'test']
 assert_in(MODE, POSSIBLE_MODES)
 
 # Parse the arguments
@@ -316,17 +2974,53 @@ Example:
 
 While this *should* be static across reboots, but sadly on some machines it isn't :(
 """)
-parser.add_argument('--by-mode', help=argparse.SUPPRESS) # help='Find board in a given mode.', )
+parser.add_argument('--by-mode', help='Find board in a given mode.', choices=BOARD_STATES)
+parser.add_argument('--by-device', help='Find the board which owns a tty or video device, for example /dev/ttyACM0.')
 
-parser.add_argument('--all', help='Do operation on all boards, otherwise will error if multiple boards are found.')
+parser.add_argument('--all', action='store_true', help='Do operation on all boards, otherwise will error if multiple boards are found.')
 
 parser.add_argument('--get-usbfs', action='store_true', help='Return the /dev/bus/usb path for a device.')
 parser.add_argument('--get-sysfs', action='store_true', help='Return the /sys/bus/usb/devices path for a device.')
 parser.add_argument('--get-state', action='store_true', help='Return the state the device is in. Possible states are: %r' % BOARD_STATES)
 parser.add_argument('--get-video-device', action='store_true', help='Get the primary video device path.')
 parser.add_argument('--get-serial-device', action='store_true', help='Get the serial device path.')
+parser.add_argument('--json', action='store_true', help='Output everything known about all the matching boards as JSON.')
 
-parser.add_argument('--prefer-hardware-serial', help='Prefer the hardware serial port on the Atlys board.')
+if MODE in ('find-board', 'mode-switch'):
+    parser.add_argument('--any-free', action='store_true', help="Use any one of the matching boards which no one else is using.")
+    parser.add_argument('--wait', type=float, help='How long to wait in seconds for boards other jobs are using (default: forever).')
+    parser.add_argument('--hold', nargs=argparse.REMAINDER, help='Run this command (and its arguments) with the boards locked, $HDMI2USB_LOCKED has their positions.')
+    parser.add_argument('--lock-stats', action='store_true', help='Print how long jobs have waited for boards and exit.')
+if MODE == 'mode-switch':
+    parser.add_argument('--no-lock', action='store_true', help="Don't lock the boards while working on them.")
+
+parser.add_argument('--prefer-hardware-serial', action='store_true', help='Prefer the hardware serial port on the Atlys board.')
+
+parser.add_argument('--usb-backend', help='How to find USB devices (default: %(default)s, also $HDMI2USB_USB_BACKEND).', choices=USB_BACKENDS, default=USB_BACKEND)
+
+parser.add_argument('--replay', help='Use the USB state saved by hdmi2usb-capture rather than the live system (also $HDMI2USB_REPLAY).', default=os.environ.get("HDMI2USB_REPLAY"))
+
+parser.add_argument('--trace', help='Write timing spans to this file (also $HDMI2USB_TRACE).')
+parser.add_argument('--trace-format', help='Format for --trace, default is chrome for .json files and jsonl otherwise.', choices=Tracer.FORMATS)
+
+if MODE == 'find-board':
+    parser.add_argument('--no-daemon', action='store_true', help="Always scan for boards rather than asking the inventory daemon.")
+if MODE == 'daemon':
+    parser.add_argument('--socket', help='Unix socket to answer queries on (default: %(default)s).', default=DAEMON_SOCKET)
+if MODE == 'benchmark':
+    testing = load_testing()
+    parser.add_argument('--devices', help='Comma separated sizes of the fake USB trees (default: 100,1000,3000, or none with --replay).')
+    parser.add_argument('--iterations', help='How many times to run each benchmark (default: %(default)s).', type=int, default=10)
+    parser.add_argument('--output', help='Write the results to this file as JSON.')
+    parser.add_argument('--compare', help='Compare against results previously written with --output.')
+    parser.add_argument('--virtual-boards', help='Comma separated numbers of simulated boards to time mode switches on (default: none).', default='')
+    parser.add_argument('--reenumerate-delay', help='How long the simulated boards take to re-enumerate in seconds (default: %(default)s).', type=float, default=0.5)
+    parser.add_argument('--inject-failures', help='Comma separated failure=probability for the simulated boards, failures are: %s.' % ", ".join(testing.VirtualFx2Host.FAILURES), default='')
+if MODE == 'test':
+    testing = load_testing()
+    parser.add_argument('tests', nargs='*', help='Names of the tests to run (default: all of them).', metavar='test')
+if MODE == 'capture':
+    parser.add_argument('--output', help='Archive to write (default: %(default)s).', default='hdmi2usb-capture-%s.tar.gz' % time.strftime('%Y%m%d-%H%M%S'))
 
 if MODE == 'mode-switch':
     parser.add_argument('--mode', help='Switch mode to given state.', choices=BOARD_STATES)
@@ -334,88 +3028,121 @@ if MODE == 'mode-switch':
     parser.add_argument('--load-fx2-firmware', help='Load firmware file onto the Cypress FX2.')
     parser.add_argument('--load-lm32-firmware', help='Load firmware file onto the lm32 Soft-Core running inside the FPGA.')
 
-    parser.add_argument('--timeout', help='How long to wait in seconds before giving up.', type=float)
+    parser.add_argument('--timeout', help='How long to wait in seconds for each board to come back before giving up, 0 waits forever (default: %(default)s).', type=float, default=30.0)
+    parser.add_argument('--force', action='store_true', help='Reload the firmware even if the board is already running it.')
+    parser.add_argument('--build-firmware-cache', action='store_true', help='Compile all the FX2 firmware into the cache and exit.')
+    parser.add_argument('--jobs', '-j', help='How many boards to work on at once with --all (default: %(default)s).', type=int, default=8)
 
 args = parser.parse_args()
 
+if args.trace:
+    TRACE.enable(args.trace, args.trace_format)
+
+if args.replay:
+    if MODE in ('mode-switch', 'capture'):
+        parser.error("--replay can't be used with %s" % MODE)
+    import atexit
+    import shutil
+    import tempfile
+    replay_dir = tempfile.mkdtemp(prefix="hdmi2usb-replay-")
+    atexit.register(shutil.rmtree, replay_dir, True)
+    SYS_ROOT, DEV_ROOT, LSUSB_FILE = replay_usb_host(args.replay, replay_dir)
+
+if MODE == 'capture':
+    count = capture_usb_host(args.output)
+    sys.stderr.write("Captured %i entries to %s\n" % (count, args.output))
+    sys.exit(0)
+
+if getattr(args, 'hold', None) == []:
+    parser.error("--hold needs a command to run")
+
+if getattr(args, 'lock_stats', False):
+    import json
+    json.dump(BOARD_SCHEDULER.stats(), sys.stdout, indent=4, sort_keys=True, separators=(",", ": "))
+    sys.stdout.write("\n")
+    sys.exit(0)
+
+if MODE == 'mode-switch' and args.build_firmware_cache:
+    for image in build_firmware_cache():
+        print "%s %s" % (image.sha256, os.path.relpath(image.filename, TOPDIR))
+    sys.exit(0)
+
 
 if BOARD != "hdmi2usb":
     args.by_type = BOARD
 if args.by_type:
     assert_in(args.by_type, BOARD_TYPES)
+if args.by_position:
+    try:
+        parse_position(args.by_position)
+    except ValueError as e:
+        parser.error(str(e))
 
 def find_hdmi2usb_boards(args):
+    with TRACE.span("find_hdmi2usb_boards", by_type=args.by_type) as span:
+        boards = _find_hdmi2usb_boards(args)
+        span.set(boards=len(boards))
+        return boards
+
+
+def _find_hdmi2usb_boards(args):
     all_boards = []
-    exart_uarts = []
-    for device in find_usb_devices_lsusb():
-        # Digilent Atlys board with stock "Adept" firmware
-        # Bus 003 Device 019: ID 1443:0007 Digilent Development board JTAG
-        if device.vid == 0x1443 and device.pid == 0x0007:
-            all_boards.append(Board(dev=device, type="atlys", state="unconfigured"))
-
-        # The Numato Opsis will boot in the following mode when the EEPROM is not
-        # set up correctly.
-        # http://opsis.hdmi2usb.tv/getting-started/usb-ids.html#failsafe-mode
-        # Bus 003 Device 091: ID 04b4:8613 Cypress Semiconductor Corp. CY7C68013 EZ-USB FX2 USB 2.0 Development Kit
-        elif device.vid == 0x04b4 and device.pid == 0x8613:
-            all_boards.append(Board(dev=device, type="opsis", state="unconfigured"))
-
-        # The preproduction Numato Opsis shipped to Champions will boot into this
-        # mode by default.
-        # The production Numato Opsis will fallback to booting in the following
-        # mode when the FPGA doesn't have EEPROM emulation working.
-        # http://opsis.hdmi2usb.tv/getting-started/usb-ids.html#unconfigured-mode
-        # Bus 003 Device 091: ID 2a19:5440 Numato Opsis (Unconfigured Mode)
-        elif device.vid == 0x2A19 and device.pid == 0x5440:
-            all_boards.append(Board(dev=device, type="opsis", state="unconfigured"))
-
-        # The production Numato Opsis will boot in this mode when SW1 is held
-        # during boot, or when held for 5 seconds with correctly configured FPGA
-        # gateware.
-        # http://opsis.hdmi2usb.tv/getting-started/usb-ids.html#usb-jtag-and-usb-uart-mode
-        # Bus 003 Device 091: ID 2a19:5441 Numato Opsis (JTAG and USB Mode)
-        elif device.vid == 0x2A19 and device.pid == 0x5441:
-            all_boards.append(Board(dev=device, type="opsis", state="jtag"))
-
-        # The production Numato Opsis will boot in this mode by default.
-        # http://opsis.hdmi2usb.tv/getting-started/usb-ids.html#hdmi2usb.tv-mode
-        # Bus 003 Device 091: ID 2a19:5441 Numato Opsis (HDMI2USB.tv mode)
-        elif device.vid == 0x2A19 and device.pid == 0x5442:
-            all_boards.append(Board(dev=device, type="opsis", state="operational"))
-
-        # fx2lib CDC-ACM example
-        # Bus 003 Device 091: ID 04b4:1004 Cypress Semiconductor Corp.
-        # [1477170.025176] usb 3-4.4: Product: There
-        # [1477170.025178] usb 3-4.4: Manufacturer: Hi
-        # [1477170.025179] usb 3-4.4: SerialNumber: ffff001ec0f1419b
-        elif device.vid == 0x04b4 and device.pid == 0x1004:
-            all_boards.append(Board(dev=device, type="opsis", state="serial"))
-
-        # Boards loaded with the ixo-usb-jtag firmware from mithro's repo
-        # https://github.com/mithro/ixo-usb-jtag
-        # Bus 003 Device 090: ID 16c0:06ad Van Ooijen Technische Informatica 
-        elif device.vid == 0x16c0 and device.pid == 0x06ad:
-            if device.serialno not in USBJTAG_MAPPING:
-                logging.warn("Unknown usb-jtag device! %r (%s)", device.serialno, device)
-                continue
-            all_boards.append(Board(dev=device, type=USBJTAG_MAPPING[device.serialno], state="jtag"))
-
-    # FIXME: This is a horrible hack!?@
-    # Patch the Atlys board so the exart_uart is associated with it.
-    if exart_uarts:
-        atlys_boards = [b for b in all_boards if b.type == "atlys"]
-        sys.stderr.write(" Found exart-uarts at %s associating with Atlys at %s\n" % (
-            exart_uarts, atlys_boards))
-        assert len(exart_uarts) == len(atlys_boards)
-        assert len(atlys_boards) == 1
-
-        def extra_tty(uart=exart_uarts[0], board=atlys_boards[0], prefer=args.prefer_hardware_serial):
-            if prefer:
-                return uart.tty + board.dev.tty
-            else:
-                return board.dev.tty + uart.tty
+    extra_uarts = {}
+    with TRACE.span("device_nodes"):
+        DEVICE_NODES.scan()
+
+    positions = None
+    if getattr(args, "by_position", None):
+        positions = [args.by_position]
+    by_device = getattr(args, "by_device", None)
+    if by_device:
+        # Only the port the device node belongs to needs to be looked at.
+        position = DEVICE_NODES.position(by_device)
+        if position is not None and (positions is None or position in positions):
+            positions = [position]
+        else:
+            positions = []
+
+    with TRACE.span("enumerate") as span:
+        backend = getattr(args, "usb_backend", None)
+        devices = find_usb_devices(positions=positions, backend=backend)
+        if by_device and not getattr(args, "by_position", None) and any(
+                BOARD_REGISTRY.uart_type(d) or BOARD_REGISTRY.has_uart(d) for d in devices):
+            # A separate USB-UART and its board can be anywhere.
+            devices = find_usb_devices(backend=backend)
+        span.set(devices=len(devices))
+
+    for device in devices:
+        uart_type = BOARD_REGISTRY.uart_type(device)
+        if uart_type:
+            extra_uarts.setdefault(uart_type, []).append(device)
+            continue
+        match = BOARD_REGISTRY.classify(device)
+        if match is None:
+            continue
+        board_type, state = match
+        all_boards.append(Board(dev=device, type=board_type, state=state))
+
+    # Nothing in the USB structure connects a separate USB-UART (like the
+    # EXAR one on the Atlys) to its board, so it can only be associated when
+    # there is one of each.
+    for board_type, uarts in extra_uarts.items():
+        typed_boards = [b for b in all_boards if b.type == board_type]
+        if len(uarts) != 1 or len(typed_boards) != 1:
+            if args.verbose > 0:
+                sys.stderr.write("Can't tell which %s the USB-UARTs at %s belong to\n" % (
+                    BOARD_NAMES[board_type], ", ".join(os.path.basename(u.syspaths[0]) for u in uarts)))
+            continue
+        uart_position = os.path.basename(uarts[0].syspaths[0])
+        if args.verbose > 0:
+            sys.stderr.write("Found USB-UART at %s, associating with %s at %s\n" % (
+                uart_position, BOARD_NAMES[board_type], typed_boards[0].position))
+        DEVICE_NODES.attach(typed_boards[0].position, uart_position,
+                            first=getattr(args, "prefer_hardware_serial", False))
 
-        atlys_boards[0].tty = extra_tty
+    if by_device:
+        node = os.path.realpath(by_device)
+        all_boards = [b for b in all_boards if node in b.tty() + b.video()]
 
     # Filter out the boards we don't care about
     filtered_boards = []
@@ -444,8 +3171,228 @@ def find_hdmi2usb_boards(args):
 
     return filtered_boards
 
-boards = find_hdmi2usb_boards(args)
-if not args.all:
+def current_board(args, board):
+    """Return board, or what is at its position now if it has re-enumerated.
+
+    A board found before its lock was taken may have been switched by the
+    lock's previous holder in the meantime.
+    """
+    if not getattr(board.dev, "stale", False):
+        return board
+
+    import argparse
+    port_args = argparse.Namespace(**vars(args))
+    port_args.by_position = board.position
+    port_args.by_type = None
+    port_args.by_device = None
+    boards = find_hdmi2usb_boards(port_args)
+    if not boards:
+        raise SystemError("%s at %s has gone away" % (board.type, board.position))
+    if boards[0].type != board.type:
+        raise SwitchWrongState("%s at %s is now %s in %s mode" % (
+            board.type, board.position, boards[0].type, boards[0].state))
+    if args.verbose:
+        sys.stderr.write("%s at %s re-enumerated (now in %s mode)\n" % (
+            board.type, board.position, boards[0].state))
+    return boards[0]
+
+
+def switch_board_mode(args, board, newmode, timeout=None):
+    """Switch a single board into newmode, returning the re-enumerated board."""
+    board = current_board(args, board)
+    firmware = BOARD_REGISTRY.firmware(board.type, newmode)
+
+    if args.verbose:
+        sys.stderr.write("Going from %s to %s\n" % (board.state, newmode))
+        sys.stderr.write("Using firmware %s\n" % firmware)
+
+    if board.state == newmode and not getattr(args, "force", False):
+        running = board_runs_firmware(board, firmware)
+        if running is not False:
+            return board
+        if args.verbose:
+            sys.stderr.write("Board is in %s mode but not running %s, reloading\n" % (newmode, firmware))
+
+    with TRACE.span("switch_board_mode", board=board.position, type=board.type,
+                    old_state=board.state, new_state=newmode):
+        with UsbEventWaiter() as events:
+            load_fx2(board, firmware, verbose=args.verbose)
+            new_board = wait_for_board(args, board, newmode, events, timeout=timeout)
+        FIRMWARE_STATE.put(new_board, load_firmware_image(os.path.abspath(firmware)))
+        return new_board
+
+
+def map_boards(func, boards, jobs=1):
+    """Call func on each board, using up to jobs threads."""
+    jobs = max(1, min(jobs or 1, len(boards)))
+    if jobs == 1:
+        return [func(board) for board in boards]
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(jobs)
+    try:
+        return pool.map(func, boards)
+    finally:
+        pool.close()
+        pool.join()
+
+
+SwitchResult = namedtuple("SwitchResult", ["board", "new_board", "status", "latency", "error"])
+
+def switch_boards_mode(args, boards, newmode, jobs=1, timeout=None):
+    """Switch all the boards into newmode using up to jobs boards at once.
+
+    Each board gets its own timeout, and a SwitchResult with a status of
+    'ok', 'timeout', 'wrong-state' or 'error' is returned for every board
+    (in the same order as boards).
+    """
+    def switch(board):
+        starttime = time.time()
+        new_board = None
+        error = None
+        try:
+            new_board = switch_board_mode(args, board, newmode, timeout=timeout)
+            status = "ok"
+        except SwitchTimeout as e:
+            status, error = "timeout", e
+        except SwitchWrongState as e:
+            status, error = "wrong-state", e
+        except Exception as e:
+            status, error = "error", e
+            logging.exception("Switching %s failed", board.dev.path)
+        return SwitchResult(board, new_board, status, time.time() - starttime, error)
+
+    return map_boards(switch, boards, jobs)
+
+
+def upload_boards_lm32_firmware(boards, filename, jobs=1):
+    """Upload filename to the lm32 on each board, up to jobs boards at once.
+
+    Returns (board, Lm32UploadResult or the exception) for every board.
+    """
+    def upload(board):
+        try:
+            return board, upload_lm32_firmware(board.tty()[0], filename)
+        except Exception as e:
+            logging.exception("Uploading to %s failed", board.dev.path)
+            return board, e
+
+    return map_boards(upload, boards, jobs)
+
+
+def load_boards_gateware(args, boards, filename, jobs=1, timeout=None):
+    """Load filename onto the FPGA on each board, switching them to jtag mode first.
+
+    Returns (board, timings or the exception) for every board.
+    """
+    def load(board):
+        try:
+            board = current_board(args, board)
+            if board.state != "jtag":
+                board = switch_board_mode(args, board, "jtag", timeout=timeout)
+            return board, load_gateware(board, filename, verbose=args.verbose)
+        except Exception as e:
+            logging.exception("Loading gateware onto %s failed", board.dev.path)
+            return board, e
+
+    return map_boards(load, boards, jobs)
+
+
+def print_switch_summary(results, output=sys.stderr):
+    for result in results:
+        output.write("%-30s %-8s %-12s -> %-12s %-12s %6.2fs%s\n" % (
+            result.board.position,
+            result.board.type,
+            result.board.state,
+            result.new_board.state if result.new_board else "?",
+            result.status,
+            result.latency,
+            [" (%s)" % result.error, ""][result.error is None],
+            ))
+    ok = [r for r in results if r.status == "ok"]
+    output.write("Switched %s of %s boards in %.2fs (slowest board).\n" % (
+        len(ok), len(results), max([r.latency for r in results] or [0])))
+
+
+def find_hdmi2usb_boards_daemon(args):
+    """Get the boards from the inventory daemon, None if it isn't running."""
+    response = query_daemon({"boards": True, "by_type": args.by_type, "by_position": args.by_position})
+    if response is None:
+        return None
+    if args.verbose:
+        sys.stderr.write("Using inventory from daemon at %s (%.1fs old)\n" % (
+            DAEMON_SOCKET, time.time() - response["scantime"]))
+    return [board_from_dict(b) for b in response["boards"]]
+
+
+if MODE == 'daemon':
+    InventoryDaemon(args, socket_path=args.socket).run()
+    sys.exit(0)
+
+if MODE == 'benchmark':
+    import json
+    devices = args.devices
+    if devices is None:
+        devices = ['100,1000,3000', ''][bool(args.replay)]
+    results = testing.run_benchmarks(args, [int(n) for n in devices.split(',') if n], args.iterations, replay=bool(args.replay))
+    failures = {}
+    for failure in args.inject_failures.split(','):
+        if failure:
+            name, probability = failure.split('=')
+            failures[name] = float(probability)
+    results += testing.run_switch_benchmarks(
+        args, [int(n) for n in args.virtual_boards.split(',') if n], args.iterations,
+        delay=args.reenumerate_delay, failures=failures)
+    baseline = None
+    if args.compare:
+        baseline = json.load(open(args.compare))["results"]
+    testing.print_benchmarks(results, baseline)
+    if args.output:
+        revision = None
+        try:
+            revision = subprocess.check_output(
+                ["git", "describe", "--always", "--dirty"], cwd=TOPDIR,
+                stderr=open(os.devnull, "w")).strip()
+        except (EnvironmentError, subprocess.CalledProcessError):
+            pass
+        with open(args.output, "w") as f:
+            json.dump({"revision": revision, "results": results}, f, indent=4, sort_keys=True, separators=(",", ": "))
+    sys.exit(0)
+
+if MODE == 'test':
+    failed = testing.run_tests(args.tests)
+    sys.exit(1 if failed else 0)
+
+def find_boards(args, probe=True):
+    boards = None
+    if MODE == 'find-board' and not args.no_daemon and not args.replay:
+        boards = find_hdmi2usb_boards_daemon(args)
+    if boards is None:
+        boards = find_hdmi2usb_boards(args)
+    elif args.by_device:
+        node = os.path.realpath(args.by_device)
+        boards = [b for b in boards if node in b.tty() + b.video()]
+    if args.by_mode:
+        boards = [b for b in boards if b.state == args.by_mode]
+    boards = filter_boards_by_identity(args, boards, probe=probe)
+    if MODE == 'mode-switch' and args.mode:
+        # Prefer the boards which are already in the right mode.
+        boards.sort(key=lambda b: b.state != args.mode)
+    return boards
+
+locks = []
+if MODE in ('find-board', 'mode-switch') and (
+        args.any_free or args.hold is not None or (MODE == 'mode-switch' and not args.no_lock)):
+    # Only the boards we have locked get their consoles probed for --by-dna/--by-mac.
+    reserved = BOARD_SCHEDULER.reserve(
+        lambda: find_boards(args, probe=False), count=[None, 1][args.any_free], timeout=args.wait,
+        type=args.by_type, state=args.by_mode, position=args.by_position,
+        check=lambda boards: filter_boards_by_identity(args, boards))
+    boards = [board for board, _ in reserved]
+    locks = [lock for _, lock in reserved if lock]
+else:
+    boards = find_boards(args)
+if not (args.all or args.json):
     assert len(boards) == 1
 
 MYDIR=os.path.dirname(os.path.abspath(__file__))
@@ -453,11 +3400,14 @@ if args.verbose:
     sys.stderr.write("My root dir: %s\n" % MYDIR)
 
 if MODE == 'mode-switch':
+    to_switch = []
+    to_load = []
+    to_upload = []
     for board in boards:
         # Load gateware onto the FPGA
         if args.load_gateware:
             assert args.mode in ("jtag", None)
-            raise NotImplemented("Not yet finished...")
+            to_load.append(board)
 
         # Load firmware onto the fx2
         elif args.load_fx2_firmware:
@@ -469,67 +3419,68 @@ if MODE == 'mode-switch':
         elif args.load_lm32_firmware:
             if board.type == "opsis":
                 assert board.state == "serial"
-            assert board.tty
-            print "flterm something...."
-            raise NotImplemented("Not yet finished...")
+            assert board.tty()
+            to_upload.append(board)
 
         # Else just switch modes
         elif args.mode:
-            newmode = args.mode
-            if newmode == "jtag":
-                firmware = os.path.join(
-                    "fx2-firmware",
-                    board.type,
-                    "ixo-usb-jtag.hex")
-
-            elif newmode == "serial":
-                assert board.type == "opsis", "serial mode only valid on the opsis."
-                firmware = os.path.join(
-                    "fx2-firmware",
-                    board.type,
-                    "usb-uart.ihx"
-                    )
-            elif newmode == "operational":
-                raise NotImplemented("Not yet finished...")
+            to_switch.append(board)
 
-            if args.verbose:
-                sys.stderr.write("Going from %s to %s\n" % (board.state, newmode))
-                sys.stderr.write("Using firmware %s\n" % firmware)
-
-            if board.state != newmode:
-                old_board = board
-                load_fx2(old_board, firmware, verbose=args.verbose)
-
-                starttime = time.time()
-                while True:
-                    boards = find_hdmi2usb_boards(args)
-
-                    found_board = None
-                    for new_board in boards:
-                        print "%s %s" % (new_board, old_board)
-                        if new_board.type == old_board.type:
-                            if new_board.state == old_board.state:
-                                continue
-                            assert new_board.state == newmode
-                            found_board = new_board
-                            break
-                    else:
-                        time.sleep(1)
-
-                    if found_board:
-                        break
-
-                    if args.timeout and starttime - time.time() > args.timeout:
-                        raise SystemError("Timeout!")
-        
         # Invalid configuration...
         else:
             raise SystemError("Need to specify --load-XXX or --mode")
 
-    boards = find_hdmi2usb_boards(args)
-
-for board in boards:
-    if not (args.get_usbfs or args.get_sysfs or args.get_video_device or args.get_serial_device):
+    if to_load:
+        data, _, size = read_bitstream(args.load_gateware)
+        data.close()
+        results = load_boards_gateware(args, to_load, args.load_gateware, jobs=args.jobs, timeout=args.timeout)
+        rescan_daemon()
+        for board, result in results:
+            if isinstance(result, Exception):
+                sys.stderr.write("%s: loading gateware failed (%s)\n" % (board.position, result))
+            else:
+                sys.stderr.write("%s: loaded %i bytes of gateware in %.2fs (%.2f MB/s)\n" % (
+                    board.position, size, sum(secs for _, secs in result),
+                    size / max(dict(result)["download"], 1e-6) / 1e6))
+        failed = [r for _, r in results if isinstance(r, Exception)]
+        if failed:
+            raise SystemError("Failed to load gateware onto %s of %s boards." % (len(failed), len(results)))
+
+    if to_upload:
+        results = upload_boards_lm32_firmware(to_upload, args.load_lm32_firmware, jobs=args.jobs)
+        for board, result in results:
+            if isinstance(result, Exception):
+                sys.stderr.write("%s: upload failed (%s)\n" % (board.tty()[0], result))
+            else:
+                sys.stderr.write("%s: uploaded %i bytes in %.2fs (%.1f kB/s, %i frames resent)\n" % (
+                    board.tty()[0], result.size, result.secs,
+                    result.size / max(result.secs, 1e-6) / 1024, result.resent))
+        failed = [r for _, r in results if isinstance(r, Exception)]
+        if failed:
+            raise SystemError("Failed to upload to %s of %s boards." % (len(failed), len(results)))
+
+    if to_switch:
+        results = switch_boards_mode(args, to_switch, args.mode, jobs=args.jobs, timeout=args.timeout)
+        rescan_daemon()
+        if len(results) > 1 or args.verbose:
+            print_switch_summary(results)
+        failed = [r for r in results if r.status != "ok"]
+        if failed:
+            raise SystemError("Failed to switch %s of %s boards." % (len(failed), len(results)))
+
+    # The device nodes change with the mode, so look the boards up again by position.
+    args.by_device = None
+    positions = set(b.position for b in boards)
+    boards = [b for b in find_hdmi2usb_boards(args) if b.position in positions]
+
+if args.json:
+    import json
+    json.dump({"boards": [board_to_dict(b) for b in boards]}, sys.stdout,
+              indent=4, sort_keys=True, separators=(",", ": "))
+    sys.stdout.write("\n")
+
+for board in [boards, []][bool(args.json)]:
+    if not (args.get_usbfs or args.get_sysfs or args.get_state or args.get_video_device or args.get_serial_device):
         print "Found %s boards." % len(boards)
         break
 
@@ -544,11 +3495,15 @@ for board in boards:
 
     if args.get_video_device:
         assert board.state == "operational"
-        print "???"
+        print board.video()[0]
 
     if args.get_serial_device:
         print board.tty()[0]
 
+if getattr(args, 'hold', None) is not None:
+    env = dict(os.environ)
+    env["HDMI2USB_LOCKED"] = os.pathsep.join(sorted(set(HELD_POSITIONS + [b.position for b in boards])))
+    sys.exit(subprocess.call(args.hold, env=env))
 
 """
         if board.state == "unconfigured":
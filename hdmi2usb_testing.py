@@ -0,0 +1,1421 @@
+# vim: set ts=4 sw=4 et sts=4 ai:
+
+"""
+Test and benchmark support for hdmi2usb-mode-switch.py.
+
+The fake USB trees, virtual FX2 boards and mock transports, along with the
+tests and benchmarks which use them. None of it is needed to find or switch
+boards, so hdmi2usb-mode-switch.py only loads it (with load_testing()) to
+run the benchmarks or the tests, rather than compiling it on every run.
+
+Run the tests with bin/hdmi2usb-test (optionally giving the names of the
+tests to run), and the benchmarks with bin/hdmi2usb-benchmark.
+"""
+
+import os
+import sys
+import threading
+import time
+
+from collections import namedtuple
+
+# The hdmi2usb-mode-switch.py module, set by its load_testing().
+ms = None
+
+
+class MockFx2Transport(object):
+    """Pretends to be an FX2 for testing fx2_load without hardware."""
+
+    def __init__(self, short_write_at=None):
+        self.memory = bytearray(0x10000)
+        self.cpucs = []
+        self.transfers = []
+        self.short_write_at = short_write_at
+
+    def control(self, request_type, request, value, index, data, timeout=1000):
+        assert request_type & ms.USB_TYPE_VENDOR, request_type
+        assert request == ms.FX2_REQUEST_FIRMWARE_LOAD, request
+
+        if request_type & ms.USB_DIR_IN:
+            self.transfers.append(("in", value, data))
+            return self.memory[value:value+data]
+
+        assert len(data) <= ms.FX2_MAX_WRITE, len(data)
+        self.transfers.append(("out", value, len(data)))
+        if value == ms.FX2_CPUCS:
+            self.cpucs.append(data[0])
+            return len(data)
+        assert self.cpucs and self.cpucs[-1] == 0x01, "Write while the 8051 is running"
+        if value == self.short_write_at:
+            return len(data) - 1
+        self.memory[value:value+len(data)] = data
+        return len(data)
+
+
+def test_fx2_load_mock():
+    mydir = os.path.dirname(os.path.abspath(__file__))
+    for filename in ("opsis/ixo-usb-jtag.hex", "opsis/usb-uart.ihx"):
+        segments = ms.parse_ihex(os.path.join(mydir, "fx2-firmware", filename))
+
+        transport = MockFx2Transport()
+        timings = ms.fx2_load(transport, segments, verify=True)
+        assert [name for name, _ in timings] == ["reset", "download", "verify", "run"], timings
+        assert transport.cpucs == [0x01, 0x00], transport.cpucs
+        expected = bytearray(0x10000)
+        for segment in segments:
+            expected[segment.address:segment.address+len(segment.data)] = segment.data
+        assert transport.memory == expected
+        writes = [t for t in transport.transfers if t[0] == "out" and t[1] != ms.FX2_CPUCS]
+        assert len(writes) < len(segments), "%r < %r" % (len(writes), len(segments))
+
+    import shutil
+    import tempfile
+    cache_dir = tempfile.mkdtemp()
+    try:
+        for image in ms.build_firmware_cache(cache_dir=cache_dir):
+            cached = ms.load_firmware_image(image.filename, cache_dir)
+            assert cached.sha256 == image.sha256
+            assert cached.segments == image.segments
+            assert os.path.exists(os.path.join(cache_dir, image.sha256))
+    finally:
+        shutil.rmtree(cache_dir)
+
+    # Sorted, contiguous records (the usual layout of a .hex file) go down in
+    # as few writes as possible.
+    for length, writes in ((100 * 16, 1), (0x2000, 2), (0x2000 + 16, 3)):
+        records = [ms.IHexSegment(address, bytearray([address & 0xff] * 16))
+                   for address in range(0, length, 16)]
+        transport = MockFx2Transport()
+        ms.fx2_load(transport, records)
+        sent = [t for t in transport.transfers if t[0] == "out" and t[1] != ms.FX2_CPUCS]
+        assert len(sent) == writes, (length, sent)
+        chunks = ms.merge_segments(records, ms.FX2_MAX_WRITE)
+        assert ms.merge_segments(chunks, ms.FX2_MAX_WRITE) == chunks
+
+    transport = MockFx2Transport(short_write_at=0x0000)
+    try:
+        ms.fx2_load(transport, segments)
+        assert False, "Short write not detected"
+    except ms.Fx2LoadError:
+        pass
+
+
+class MockJtagTransport(object):
+    """Decodes the USB-Blaster byte stream and runs it through a JTAG TAP.
+
+    Records the instructions loaded and the data shifted into the data
+    register (most significant bit first, as the FPGA would see it).
+    """
+
+    NEXT_STATE = {
+        "reset": ("idle", "reset"),
+        "idle": ("idle", "select-dr"),
+        "select-dr": ("capture-dr", "select-ir"),
+        "capture-dr": ("shift-dr", "exit1-dr"),
+        "shift-dr": ("shift-dr", "exit1-dr"),
+        "exit1-dr": ("pause-dr", "update-dr"),
+        "pause-dr": ("pause-dr", "exit2-dr"),
+        "exit2-dr": ("shift-dr", "update-dr"),
+        "update-dr": ("idle", "select-dr"),
+        "select-ir": ("capture-ir", "reset"),
+        "capture-ir": ("shift-ir", "exit1-ir"),
+        "shift-ir": ("shift-ir", "exit1-ir"),
+        "exit1-ir": ("pause-ir", "update-ir"),
+        "pause-ir": ("pause-ir", "exit2-ir"),
+        "exit2-ir": ("shift-ir", "update-ir"),
+        "update-ir": ("idle", "select-dr"),
+        }
+
+    def __init__(self):
+        self.state = "reset"
+        self.pins = 0
+        self.shift = 0
+        self.claimed = set()
+        self.transfers = []
+        self.instructions = []
+        self.ir = []
+        self.dr = {}
+        self.bits = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def claim_interface(self, interface):
+        self.claimed.add(interface)
+
+    def clock(self, tms, tdi):
+        if self.state == "shift-ir":
+            self.ir.append(tdi)
+        elif self.state == "shift-dr":
+            self.bits.append(tdi)
+        self.state = self.NEXT_STATE[self.state][tms]
+        if self.state == "update-ir":
+            self.instructions.append(sum(b << i for i, b in enumerate(self.ir)))
+            self.ir = []
+        elif self.state == "update-dr":
+            instruction = self.instructions[-1]
+            self.dr.setdefault(instruction, bytearray()).extend(
+                sum(b << (7 - i) for i, b in enumerate(self.bits[j:j+8]))
+                for j in range(0, len(self.bits), 8))
+            self.bits = []
+
+    def bulk(self, endpoint, data, timeout=1000):
+        assert endpoint == ms.JTAG_EP_OUT, endpoint
+        assert ms.JTAG_INTERFACE in self.claimed
+        self.transfers.append(len(data))
+        for byte in bytearray(data):
+            if self.shift:
+                for i in range(8):
+                    self.clock(0, (byte >> i) & 1)
+                self.shift -= 1
+            elif byte & ms.JTAG_SHIFT:
+                self.shift = byte & ms.JTAG_MAX_SHIFT
+            else:
+                if byte & ms.JTAG_TCK and not self.pins & ms.JTAG_TCK:
+                    self.clock(int(bool(byte & ms.JTAG_TMS)), int(bool(byte & ms.JTAG_TDI)))
+                self.pins = byte
+        return len(data)
+
+
+def test_gateware_load_mock():
+    import struct
+    import tempfile
+
+    bitstream = os.urandom(100000)
+    header = "\x00\x09\x0f\xf0\x0f\xf0\x0f\xf0\x0f\xf0\x00\x00\x01"
+    for tag, value in (("a", "top.ncd\0"), ("b", "6slx45tfgg484\0"), ("c", "2016/01/01\0"), ("d", "00:00:00\0")):
+        header += tag + struct.pack(">H", len(value)) + value
+    header += "e" + struct.pack(">I", len(bitstream))
+
+    for suffix, contents in ((".bit", header + bitstream), (".bin", bitstream)):
+        with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+            f.write(contents)
+            f.flush()
+            data, offset, length = ms.read_bitstream(f.name)
+            transport = MockJtagTransport()
+            transport.claim_interface(ms.JTAG_INTERFACE)
+            timings = ms.jtag_load_bitstream(transport, data, offset, length)
+            data.close()
+
+        assert [name for name, _ in timings] == ["program", "download", "start"], timings
+        assert transport.instructions == [ms.XC6S_JPROGRAM, ms.XC6S_CFG_IN, ms.XC6S_JSTART], transport.instructions
+        assert transport.dr[ms.XC6S_CFG_IN] == bytearray(bitstream)
+        assert transport.state == "idle", transport.state
+        assert max(transport.transfers) == 16384, transport.transfers
+
+    with tempfile.NamedTemporaryFile(suffix=".bit") as f:
+        f.write(header + bitstream[:100])
+        f.flush()
+        try:
+            ms.read_bitstream(f.name)
+            assert False, "Truncated bitstream not detected"
+        except ms.GatewareError:
+            pass
+
+
+def test_firmware_descriptor():
+    mydir = os.path.dirname(os.path.abspath(__file__))
+    for filename, vid, pid, bcd, serial in (
+            ("opsis/ixo-usb-jtag.hex", 0x16c0, 0x06ad, 0x0004, "hw_opsis"),
+            ("opsis/usb-uart.ihx", 0x04b4, 0x1004, 0x0001, None)):
+        segments = ms.parse_ihex(os.path.join(mydir, "fx2-firmware", filename))
+        descriptor = ms.firmware_descriptor(segments)
+        assert descriptor[:3] == (vid, pid, bcd), (filename, descriptor)
+        if serial:
+            assert serial in descriptor.strings, (filename, descriptor)
+
+
+class FakeSerialBoot(threading.Thread):
+    """Pretend to be the lm32 BIOS on the other end of a pty.
+
+    The frames numbered in corrupt get a CRC error, and at the frames
+    numbered in drop the BIOS gives up on the upload and goes back to its
+    prompt (without acknowledging anything more) until it's asked to serial
+    boot again.
+    """
+
+    def __init__(self, fd, address=None, corrupt=(), drop=()):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fd = fd
+        self.address = ms.LM32_LOAD_ADDRESS if address is None else address
+        self.corrupt = set(corrupt)
+        self.drop = set(drop)
+        self.boots = 0
+        self.memory = bytearray()
+        self.frames = 0
+        self.jumped = None
+        self.buf = ""
+
+    def read(self, size):
+        while len(self.buf) < size:
+            data = ms.serial_read(self.fd, 5.0)
+            if not data:
+                raise IOError("Host went away")
+            self.buf += data
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def run(self):
+        while not self.serialboot():
+            pass
+
+    def serialboot(self):
+        """Take one upload, returning True if it ended with a jump."""
+        command = ""
+        while "serialboot" not in command:
+            command += self.read(1)
+        self.boots += 1
+        ms._write_all(self.fd, ms.SFL_MAGIC_REQ)
+        # Like the BIOS, skip anything (the rest of the command line) before the ack.
+        ack = ""
+        while not ack.endswith(ms.SFL_MAGIC_ACK):
+            ack += self.read(1)
+        while True:
+            length, crc_hi, crc_lo, cmd = bytearray(self.read(4))
+            payload = self.read(length)
+            self.frames += 1
+            if self.frames in self.drop:
+                return False
+            if self.frames in self.corrupt or ms.crc16(chr(cmd) + payload) != (crc_hi << 8 | crc_lo):
+                ms._write_all(self.fd, ms.SFL_ACK_CRCERROR)
+                continue
+            address = sum(ord(c) << shift for c, shift in zip(payload[:4], (24, 16, 8, 0)))
+            if cmd == ms.SFL_CMD_LOAD:
+                start = address - self.address
+                if len(self.memory) < start + length - 4:
+                    self.memory.extend("\0" * (start + length - 4 - len(self.memory)))
+                self.memory[start:start+length-4] = payload[4:]
+                ms._write_all(self.fd, ms.SFL_ACK_SUCCESS)
+            elif cmd == ms.SFL_CMD_JUMP:
+                self.jumped = address
+                ms._write_all(self.fd, ms.SFL_ACK_SUCCESS)
+                return True
+            else:
+                ms._write_all(self.fd, ms.SFL_ACK_UNKNOWN)
+
+
+def test_lm32_upload_pty():
+    import pty
+    import tempfile
+    import tty
+
+    assert ms.crc16("123456789") == 0x31c3
+
+    image = bytearray(os.urandom(20000))
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(image)
+        f.flush()
+        for corrupt in ((), (3, 4, 40)):
+            master, slave = pty.openpty()
+            try:
+                tty.setraw(master)
+                bios = FakeSerialBoot(master, corrupt=corrupt)
+                bios.start()
+                result = ms.upload_lm32_firmware(os.ttyname(slave), f.name)
+                bios.join(5)
+                assert bios.memory == image
+                assert bios.jumped == ms.LM32_LOAD_ADDRESS
+                assert result.size == len(image)
+                assert bool(result.resent) == bool(corrupt), result
+            finally:
+                os.close(master)
+                os.close(slave)
+
+        # A BIOS which gives up part way is asked to serial boot again, and
+        # the upload carries on from where it got to (without waiting for
+        # all the retries first).
+        master, slave = pty.openpty()
+        try:
+            tty.setraw(master)
+            bios = FakeSerialBoot(master, corrupt=(3,), drop=(30,))
+            bios.start()
+            result = ms.upload_lm32_firmware(os.ttyname(slave), f.name)
+            bios.join(5)
+            assert bios.memory == image
+            assert bios.jumped == ms.LM32_LOAD_ADDRESS
+            assert bios.boots == result.attempts == 2, (bios.boots, result)
+            # The frames in flight when the BIOS went away, and the one with the CRC error.
+            assert result.resent > 1, result
+            assert result.secs < 4, result
+            # Frames from before the last acknowledged one aren't sent again.
+            assert bios.frames < 2 * len(image) / ms.SFL_MAX_DATA, bios.frames
+        finally:
+            os.close(master)
+            os.close(slave)
+
+
+class FakeConsole(threading.Thread):
+    """Pretend to be the firmware console on the other end of a pty."""
+
+    REPLY = "DNA: 0x00123456789abcde\r\nMAC: D8-80-39-5A-11-22\r\n"
+
+    def __init__(self, fd):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fd = fd
+        self.probes = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        command = ""
+        while not self.stopped.is_set():
+            command += ms.serial_read(self.fd, 0.1)
+            if "version" in command:
+                command = command.split("version", 1)[1]
+                self.probes += 1
+                ms._write_all(self.fd, self.REPLY)
+
+
+def test_identity_cache():
+    import argparse
+    import pty
+    import shutil
+    import tempfile
+    import tty
+
+    assert ms.normalise_dna("0x00123456789ABCDE") == "123456789abcde"
+    assert ms.normalise_dna("123456789abcde") == "123456789abcde"
+    assert ms.normalise_mac("D8-80-39-5A-11-22") == "d8:80:39:5a:11:22"
+    assert ms.normalise_mac("d8:80:39:5a:11:22") == "d8:80:39:5a:11:22"
+
+    Dev = namedtuple("Dev", ["vid", "pid", "serialno"])
+
+    class ConsoleBoard(namedtuple("ConsoleBoard", ["position", "type", "state", "dev", "ttyname"])):
+        def tty(self):
+            return [self.ttyname]
+
+    def by(dna=None, mac=None):
+        return argparse.Namespace(by_dna=dna, by_mac=mac, verbose=0)
+
+    tmpdir = tempfile.mkdtemp()
+    master, slave = pty.openpty()
+    console = FakeConsole(master)
+    try:
+        tty.setraw(master)
+        console.start()
+        cache = ms.IdentityCache(os.path.join(tmpdir, "identity.json"))
+        board = ConsoleBoard("1-1", "opsis", "operational",
+                             Dev(0x2A19, 0x5441, "0123"), os.ttyname(slave))
+        expected = ms.Identity(dna="123456789abcde", mac="d8:80:39:5a:11:22")
+
+        # Nothing is cached yet; without probe the board is kept untouched.
+        assert cache.get(board) is None
+        assert ms.filter_boards_by_identity(by(dna="0x00123456789ABCDE"), [board], cache, probe=False) == [board]
+        assert console.probes == 0
+
+        # Probing finds it (in either spelling) and stores it.
+        assert ms.filter_boards_by_identity(by(dna="0x00123456789ABCDE"), [board], cache) == [board]
+        assert console.probes == 1
+        assert cache.get(board) == expected
+
+        # Later lookups are cache hits, with or without probe.
+        assert ms.filter_boards_by_identity(by(mac="D8-80-39-5A-11-22"), [board], cache) == [board]
+        assert ms.filter_boards_by_identity(by(dna="123456789abcdf"), [board], cache) == []
+        assert ms.filter_boards_by_identity(by(mac="d8:80:39:5a:11:23"), [board], cache, probe=False) == []
+        assert console.probes == 1
+
+        # A different device, or the same one somewhere else, misses.
+        for other in (board._replace(dev=board.dev._replace(vid=0x1D50)),
+                      board._replace(dev=board.dev._replace(pid=0x5442)),
+                      board._replace(dev=board.dev._replace(serialno="0124")),
+                      board._replace(position="1-2")):
+            assert cache.get(other) is None, other
+            assert ms.filter_boards_by_identity(by(dna="123456789abcde"), [other], cache, probe=False) == [other]
+        assert console.probes == 1
+        moved = board._replace(position="1-2")
+        assert cache.lookup(moved) == expected
+        assert console.probes == 2
+
+        # The cache file is shared; a fresh instance sees both entries.
+        cache = ms.IdentityCache(cache.filename)
+        assert cache.get(board) == cache.get(moved) == expected
+
+        # Boards which can't be probed are unknown and filtered out.
+        absent = board._replace(position="1-3", state="jtag")
+        assert ms.filter_boards_by_identity(by(dna="123456789abcde"), [absent, board], cache) == [board]
+        assert cache.get(absent) is None
+    finally:
+        console.stopped.set()
+        console.join(5)
+        os.close(master)
+        os.close(slave)
+        shutil.rmtree(tmpdir)
+
+
+def test_board_scheduler():
+    import StringIO
+    import shutil
+    import tempfile
+
+    FakeBoard = namedtuple("FakeBoard", ["position", "type", "state"])
+    boards = [FakeBoard("1-1.%i" % i, "opsis", ["jtag", "serial"][i % 2]) for i in range(4)]
+
+    lock_dir = tempfile.mkdtemp()
+    try:
+        scheduler = ms.BoardScheduler(lock_dir, held=[])
+        first = scheduler.reserve(lambda: [b for b in boards if b.state == "jtag"], count=1, timeout=0)
+        second = scheduler.reserve(lambda: [b for b in boards if b.state == "jtag"], count=1, timeout=0)
+        assert first[0][0] != second[0][0], (first, second)
+        try:
+            scheduler.reserve(lambda: [b for b in boards if b.state == "jtag"], count=1, timeout=0)
+            assert False, "All the jtag boards are locked"
+        except ms.BoardsBusy:
+            pass
+
+        # Waiting says (once) who has the boards.
+        output = StringIO.StringIO()
+        try:
+            scheduler.reserve(lambda: [first[0][0]], timeout=1.2, output=output)
+            assert False, "The board is locked"
+        except ms.BoardsBusy:
+            pass
+        assert output.getvalue().count("\n") == 1, output.getvalue()
+        assert "%s (pid %i, " % (first[0][0].position, os.getpid()) in output.getvalue(), output.getvalue()
+
+        # Locks are per process (flock), so a parent's boards are passed down.
+        child = ms.BoardScheduler(lock_dir, held=[first[0][0].position])
+        assert child.reserve(lambda: [first[0][0]], timeout=0)[0][1] is None
+
+        for _, lock in first:
+            lock.release()
+        third = scheduler.reserve(lambda: boards, timeout=0, count=1)
+        assert third[0][0] == first[0][0], third
+
+        stats = scheduler.stats()
+        assert stats["count"] == 4, stats
+
+        # check() is only given locked boards, and those it turns down are
+        # unlocked and not tried again.
+        for _, lock in second + third:
+            lock.release()
+        checked = []
+        def check(found):
+            checked.append([b.position for b in found])
+            return [b for b in found if b != boards[0]]
+        reserved = scheduler.reserve(lambda: boards, count=2, timeout=0, check=check)
+        assert [b for b, _ in reserved] == boards[1:3], reserved
+        assert checked == [[b.position for b in boards[0:2]], [b.position for b in boards[1:3]]], checked
+        lock = ms.BoardLock(boards[0].position, lock_dir)
+        assert lock.try_acquire()
+        lock.release()
+
+        # Links and other files left in the (shared) lock directory are refused.
+        target = os.path.join(lock_dir, "target")
+        with open(target, "w") as f:
+            f.write("precious")
+        os.symlink(target, os.path.join(lock_dir, "9-1.lock"))
+        os.mkfifo(os.path.join(lock_dir, "9-2.lock"))
+        for position in ("9-1", "9-2"):
+            try:
+                ms.BoardLock(position, lock_dir).try_acquire()
+            except SystemError:
+                pass
+            else:
+                assert False, position
+        assert open(target).read() == "precious"
+    finally:
+        shutil.rmtree(lock_dir)
+
+
+# (vid, pid, serialno, [(driver, tty), ...] for each interface)
+FAKE_USB_DEVICES = [
+    # Boards
+    ("2a19", "5442", "0123456789", [("uvcvideo", "video"), ("uvcvideo", None), ("cdc_acm", "ttyACM"), ("cdc_acm", None)]),
+    ("2a19", "5440", None, [(None, None)]),
+    ("2a19", "5441", None, [(None, None), ("cdc_acm", "ttyACM"), ("cdc_acm", None)]),
+    ("04b4", "8613", None, [(None, None)]),
+    ("04b4", "1004", "ffff001ec0f1419b", [("cdc_acm", "ttyACM"), ("cdc_acm", None)]),
+    ("16c0", "06ad", "hw_opsis", [(None, None), ("ftdi_sio", "ttyUSB")]),
+    ("16c0", "06ad", "hw_nexys", [(None, None), ("ftdi_sio", "ttyUSB")]),
+    ("1443", "0007", None, [(None, None)]),
+    # Other things found on test rigs
+    ("046d", "c52b", None, [("usbhid", None), ("usbhid", None), ("usbhid", None)]),
+    ("0403", "6001", "A600ABCD", [("ftdi_sio", "ttyUSB")]),
+    ("0781", "5567", "4C530001", [("usb-storage", None)]),
+    ("0bda", "8153", "000001", [("r8152", None)]),
+    ("8087", "0a2b", None, [("btusb", None), ("btusb", None)]),
+    ]
+
+class FakeUsbTree(object):
+    """A fake /sys/bus/usb/devices and /dev/bus/usb under root.
+
+    Laid out like the real thing, device and interface directories live
+    under sys/devices (interfaces and child devices being subdirectories of
+    their device) with symlinks to them in sys/bus/usb/devices, and to their
+    tty and video nodes in sys/class.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.sys_root = os.path.join(root, "sys", "bus", "usb", "devices")
+        self.dev_root = os.path.join(root, "dev", "bus", "usb")
+        self.drivers_root = os.path.join(root, "sys", "bus", "usb", "drivers")
+        self.devices_root = os.path.join(root, "sys", "devices", "fake")
+        self.class_roots = {
+            "tty": os.path.join(root, "sys", "class", "tty"),
+            "video": os.path.join(root, "sys", "class", "video4linux"),
+            }
+        for d in [self.sys_root, self.dev_root, self.drivers_root, self.devices_root] + list(self.class_roots.values()):
+            if not os.path.isdir(d):
+                os.makedirs(d)
+        self.ttys = {}
+
+    def realpath(self, dirname):
+        if dirname.startswith("usb"):
+            return os.path.join(self.devices_root, dirname)
+        bus, ports = ms.parse_position(dirname)
+        if len(ports) == 1:
+            parent = "usb%i" % bus
+        else:
+            parent = dirname.rsplit(".", 1)[0]
+        return os.path.join(self.realpath(parent), dirname)
+
+    def add(self, dirname, bus, devnum, vid, pid, serialno=None, interfaces=(), bcd=None):
+        """Add a device, interfaces is a list of (driver, node prefix).
+
+        A node prefix of "video" gives a video4linux device, anything else
+        a tty.
+        """
+        dirpath = self.realpath(dirname)
+        os.mkdir(dirpath)
+
+        attrs = {"busnum": bus, "devnum": devnum, "idVendor": vid, "idProduct": pid}
+        if serialno:
+            attrs["serial"] = serialno
+        if bcd is not None:
+            attrs["bcdDevice"] = "%04x" % bcd
+        for name, value in attrs.items():
+            with open(os.path.join(dirpath, name), "w") as f:
+                f.write("%s\n" % value)
+
+        busdir = os.path.join(self.dev_root, "%03i" % bus)
+        if not os.path.isdir(busdir):
+            os.mkdir(busdir)
+        open(os.path.join(busdir, "%03i" % devnum), "w").close()
+
+        if dirname.startswith("usb"):
+            ifprefix = "%s-0" % dirname[3:]
+        else:
+            ifprefix = dirname
+        for i, (driver, node) in enumerate(interfaces):
+            ifname = "%s:1.%i" % (ifprefix, i)
+            ifpath = os.path.join(dirpath, ifname)
+            os.mkdir(ifpath)
+            os.symlink(ifpath, os.path.join(self.sys_root, ifname))
+            if driver:
+                driverpath = os.path.join(self.drivers_root, driver)
+                if not os.path.isdir(driverpath):
+                    os.mkdir(driverpath)
+                    open(os.path.join(driverpath, "unbind"), "w").close()
+                os.symlink(driverpath, os.path.join(ifpath, "driver"))
+            if node:
+                n = self.ttys.get(node, 0)
+                self.ttys[node] = n + 1
+                kind = ["tty", "video"][node == "video"]
+                name = "%s%i" % (node, n)
+                nodepath = os.path.join(ifpath, ["tty", "video4linux"][kind == "video"], name)
+                os.makedirs(nodepath)
+                os.symlink(nodepath, os.path.join(self.class_roots[kind], name))
+
+        # Last, so the device never appears half made.
+        os.symlink(dirpath, os.path.join(self.sys_root, dirname))
+
+    def remove(self, dirname):
+        """Remove a device (which must not have any child devices)."""
+        import shutil
+
+        dirpath = self.realpath(dirname)
+        bus = int(ms.read_sysfs_attr(dirpath, "busnum"))
+        devnum = int(ms.read_sysfs_attr(dirpath, "devnum"))
+        for name in os.listdir(dirpath):
+            if ":" in name:
+                os.unlink(os.path.join(self.sys_root, name))
+                for kind, subdir in (("tty", "tty"), ("video", "video4linux")):
+                    nodedir = os.path.join(dirpath, name, subdir)
+                    if os.path.isdir(nodedir):
+                        for node in os.listdir(nodedir):
+                            os.unlink(os.path.join(self.class_roots[kind], node))
+        os.unlink(os.path.join(self.sys_root, dirname))
+        shutil.rmtree(dirpath)
+        os.unlink(os.path.join(self.dev_root, "%03i" % bus, "%03i" % devnum))
+
+
+def test_sysfs_cache():
+    import argparse
+    import shutil
+    import tempfile
+
+    basenames = lambda paths: [os.path.basename(p) for p in paths]
+    tmpdir = tempfile.mkdtemp()
+    try:
+        tree = FakeUsbTree(os.path.join(tmpdir, "tree"))
+        tree.add("usb1", 1, 1, "1d6b", "0002", None, [("hub", None)])
+        tree.add("1-1", 1, 2, "2a19", "5440", None, [(None, None)])
+        cache = ms.SysfsCache(tree.sys_root)
+
+        assert cache.scan() == (set(["usb1", "1-1"]), set())
+        assert cache.scan() == (set(), set())
+        entries = dict((os.path.basename(e.dirpath), e) for e in cache.entries())
+        assert basenames(entries["usb1"].syspaths) == ["usb1", "1-0:1.0"], entries["usb1"].syspaths
+        old = entries["1-1"]
+        assert basenames(old.syspaths) == ["1-1", "1-1:1.0"], old.syspaths
+        assert not cache.is_stale(old.path)
+
+        # Re-enumerating with a new devnum (and interfaces) re-reads the device.
+        tree.remove("1-1")
+        tree.add("1-1", 1, 3, "2a19", "5441", None, [(None, None), ("cdc_acm", "ttyACM"), ("cdc_acm", None)])
+        assert cache.scan() == (set(), set())
+        new = [e for e in cache.entries() if os.path.basename(e.dirpath) == "1-1"][0]
+        assert (new.pid, new.path.address) == (0x5441, 3), new.path
+        assert new.version != old.version
+        assert basenames(new.syspaths) == ["1-1", "1-1:1.0", "1-1:1.1", "1-1:1.2"], new.syspaths
+        assert cache.is_stale(old.path) and not cache.is_stale(new.path)
+
+        tree.remove("1-1")
+        tree.add("1-2", 1, 4, "2a19", "5440", None, [(None, None)])
+        assert cache.scan() == (set(["1-2"]), set(["1-1"]))
+        assert cache.is_stale(new.path)
+
+        # Devices which appear after a scan (like ones libusb has just found)
+        # are picked up, and ones which have already gone again are a KeyError.
+        tree.add("1-3", 1, 6, "2a19", "5440", None, [(None, None)])
+        assert basenames(ms.find_sys(ms.Path(bus=1, address=6), cache)) == ["1-3", "1-3:1.0"]
+        tree.add("1-4", 1, 7, "2a19", "5440", None, [(None, None)])
+        tree.remove("1-4")
+        try:
+            ms.find_sys(ms.Path(bus=1, address=7), cache)
+        except KeyError:
+            pass
+        else:
+            assert False, "found a device which has gone"
+
+        # Devices know when they have re-enumerated.
+        device = [d for d in ms.find_usb_devices_sysfs(sys_root=tree.sys_root) if d.path.address == 4][0]
+        assert not device.stale
+        tree.remove("1-2")
+        tree.add("1-2", 1, 5, "2a19", "5441", None, [(None, None)])
+        assert device.stale
+
+        # So a board switched by someone else after it was found isn't switched again.
+        args = argparse.Namespace(verbose=0, force=False, by_type=None, by_position=None, usb_backend="sysfs")
+        with VirtualFx2Host(os.path.join(tmpdir, "virtual"), delay=0.05) as host:
+            host.plug("opsis")
+            board = ms.find_hdmi2usb_boards(args)[0]
+            ms.switch_boards_mode(args, [board], "jtag", timeout=5)
+            assert len(host.loads) == 1
+            switched = ms.switch_board_mode(args, board, "jtag", timeout=5)
+            assert switched.state == "jtag" and len(host.loads) == 1, host.loads
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_scan_port():
+    import argparse
+    import shutil
+    import tempfile
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        tree = FakeUsbTree(tmpdir)
+        tree.add("usb1", 1, 1, "1d6b", "0002", None, [("hub", None)])
+        tree.add("1-1", 1, 2, "05e3", "0608", None, [("hub", None)])
+        tree.add("1-1.3", 1, 3, "2a19", "5440", None, [(None, None)])
+        cache = ms.SysfsCache(tree.sys_root)
+
+        assert cache.scan_port("1-2") is None
+        assert cache.scan_port("1-1.4") is None
+
+        roothub = cache.scan_port("usb1")
+        assert (roothub.vid, roothub.pid, roothub.path.address) == (0x1d6b, 0x0002, 1)
+        assert [os.path.basename(p) for p in roothub.syspaths] == ["usb1", "1-0:1.0"], roothub.syspaths
+
+        old = cache.scan_port("1-1.3")
+        assert (old.pid, old.path.address) == (0x5440, 3)
+        assert cache.scan_port("1-1.3") is old
+
+        # Back at the same port with a new address and VID:PID.
+        tree.remove("1-1.3")
+        tree.add("1-1.3", 1, 4, "16c0", "06ad", "hw_opsis", [(None, None), ("ftdi_sio", "ttyUSB")])
+        new = cache.scan_port("1-1.3")
+        assert (new.vid, new.pid, new.serialno, new.path.address) == (0x16c0, 0x06ad, "hw_opsis", 4)
+        assert [os.path.basename(p) for p in new.syspaths] == ["1-1.3", "1-1.3:1.0", "1-1.3:1.1"], new.syspaths
+        assert cache.is_stale(old.path) and not cache.is_stale(new.path)
+
+        # --by-position only looks at that port.
+        args = argparse.Namespace(verbose=0, by_type=None, by_position="1-1.3", usb_backend="sysfs")
+        sys_root = ms.SYS_ROOT
+        ms.SYS_ROOT = tree.sys_root
+        ms.FIND_SYS_CACHE.clear()
+        try:
+            boards = ms.find_hdmi2usb_boards(args)
+            assert [(b.position, b.type, b.state) for b in boards] == [("1-1.3", "opsis", "jtag")], boards
+            assert ms.FIND_SYS_CACHE.entries() == [ms.FIND_SYS_CACHE.scan_port("1-1.3")]
+            tree.remove("1-1.3")
+            assert ms.find_hdmi2usb_boards(args) == []
+        finally:
+            ms.SYS_ROOT = sys_root
+            ms.FIND_SYS_CACHE.clear()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def create_fake_usb_tree(root, devices=100, hub_ports=7, boards=0.25, seed=0):
+    """Create a FakeUsbTree under root full of devices.
+
+    About devices devices are spread over as many buses as needed (a bus
+    only has 127 addresses) behind nested hubs with hub_ports ports, with
+    roughly the given fraction of them being HDMI2USB boards.
+
+    Returns (sys_root, dev_root).
+    """
+    import random
+    rand = random.Random(seed)
+
+    tree = FakeUsbTree(root)
+    add = tree.add
+
+    hub = [("hub", None)]
+    board_devices = [d for d in FAKE_USB_DEVICES if d[:2] in (
+        ("%04x" % vid, "%04x" % pid) for vid, pid in ms.BOARD_REGISTRY.index)]
+    other_devices = [d for d in FAKE_USB_DEVICES if d not in board_devices]
+
+    remaining = devices
+    bus = 0
+    while remaining > 0:
+        bus += 1
+        devnum = 1
+        add("usb%i" % bus, bus, devnum, "1d6b", "0002", None, hub)
+
+        ports = [("%i-%i" % (bus, p), 1) for p in range(1, hub_ports+1)]
+        while ports and remaining > 0 and devnum < 127:
+            dirname, depth = ports.pop(0)
+            devnum += 1
+            remaining -= 1
+            # USB allows up to 5 tiers of hubs below the root hub.
+            if depth < 5 and rand.random() < 0.2:
+                add(dirname, bus, devnum, "05e3", "0608", None, hub)
+                ports.extend(("%s.%i" % (dirname, p), depth+1) for p in range(1, hub_ports+1))
+            else:
+                if rand.random() < boards:
+                    vid, pid, serialno, interfaces = rand.choice(board_devices)
+                else:
+                    vid, pid, serialno, interfaces = rand.choice(other_devices)
+                add(dirname, bus, devnum, vid, pid, serialno, interfaces)
+
+    return tree.sys_root, tree.dev_root
+
+
+UsbId = namedtuple("UsbId", ["vid", "pid", "serialno"])
+
+def fake_board_device(board_type, state=None, vid=None, pid=None):
+    """The first FAKE_USB_DEVICES entry for a board_type board in state (or with vid and pid)."""
+    for device in FAKE_USB_DEVICES:
+        usb_id = UsbId(int(device[0], 16), int(device[1], 16), device[2])
+        if vid is not None and (usb_id.vid, usb_id.pid) != (vid, pid):
+            continue
+        match = ms.BOARD_REGISTRY.classify(usb_id)
+        if match and match[0] == board_type and state in (None, match[1]):
+            return device
+    return None
+
+
+def firmware_device(board_type, descriptor):
+    """The FAKE_USB_DEVICES entry for a board_type board running firmware with descriptor.
+
+    Like a real board, it has the firmware's VID:PID and the serial number
+    the firmware reports (one of its strings), whatever type of board it is.
+    """
+    for device in FAKE_USB_DEVICES:
+        if (int(device[0], 16), int(device[1], 16)) == (descriptor.vid, descriptor.pid) and (
+                device[2] in descriptor.strings):
+            return device
+    return fake_board_device(board_type, vid=descriptor.vid, pid=descriptor.pid) or (
+        "%04x" % descriptor.vid, "%04x" % descriptor.pid, None, [(None, None)])
+
+
+class VirtualFx2Transport(MockFx2Transport):
+    """A transport to one of the boards of a VirtualFx2Host."""
+
+    def __init__(self, host, position, devnum, failure=None):
+        MockFx2Transport.__init__(self)
+        self.host = host
+        self.position = position
+        self.devnum = devnum
+        self.failure = failure
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def control(self, request_type, request, value, index, data, timeout=1000):
+        if not self.host.connected(self.position, self.devnum):
+            raise IOError("%s has disconnected" % self.position)
+        if self.failure == "short-write" and value != ms.FX2_CPUCS:
+            return len(data) - 1
+        result = MockFx2Transport.control(self, request_type, request, value, index, data, timeout)
+        if value == ms.FX2_CPUCS and not request_type & ms.USB_DIR_IN and data[0] == 0x00:
+            self.host.run(self.position, self.memory, self.failure)
+        return result
+
+
+class VirtualFx2Host(object):
+    """Simulated FX2 boards, to exercise mode switches without hardware.
+
+    The boards live in a FakeUsbTree under root. While the host is
+    installed SYS_ROOT and DEV_ROOT point at that tree and open_transport()
+    gives a VirtualFx2Transport for the boards, which takes a firmware load
+    like a real FX2. When the 8051 is let out of reset the board disconnects
+    and, delay (+/- jitter) seconds later, re-enumerates as whatever the
+    firmware's device descriptor says.
+
+    failures maps the failures which can be injected into a load to the
+    probability of each:
+      short-write - a firmware write comes up short
+      disconnect  - the board disconnects and never comes back
+      wrong-state - the board comes back unconfigured, as if the firmware
+                    didn't start
+    """
+
+    FAILURES = ["short-write", "disconnect", "wrong-state"]
+    BUS = 1
+
+    def __init__(self, root, delay=0.5, jitter=0.0, failures=None, seed=0):
+        import random
+
+        for failure in (failures or {}):
+            ms.assert_in(failure, self.FAILURES)
+        self.tree = FakeUsbTree(root)
+        self.delay = delay
+        self.jitter = jitter
+        self.failures = dict(failures or {})
+        self.rand = random.Random(seed)
+        self.lock = threading.RLock()
+        # position -> {"type", "device" (a FAKE_USB_DEVICES entry), "devnum" (None when disconnected)}
+        self.boards = {}
+        # (position, failure or None) for every firmware load
+        self.loads = []
+        self.timers = []
+        self.saved = None
+
+        self.devnums = set([1])
+        self.last_devnum = 1
+        self.tree.add("usb%i" % self.BUS, self.BUS, 1, "1d6b", "0002", None, [("hub", None)])
+
+    def plug(self, board_type, state="unconfigured"):
+        """Plug in a board, returning its position."""
+        device = fake_board_device(board_type, state)
+        assert device is not None, (board_type, state)
+        with self.lock:
+            position = "%i-%i" % (self.BUS, len(self.boards) + 1)
+            self.boards[position] = {"type": board_type, "device": device, "devnum": None}
+            # Not running anything we know about.
+            self._connect(position, device, bcd=0)
+        return position
+
+    def _next_devnum(self):
+        # Like the kernel, hand out the next free address (wrapping at 127).
+        devnum = self.last_devnum
+        for i in range(127):
+            devnum = devnum % 127 + 1
+            if devnum not in self.devnums:
+                break
+        else:
+            raise IOError("No free addresses on bus %i" % self.BUS)
+        self.devnums.add(devnum)
+        self.last_devnum = devnum
+        return devnum
+
+    def _connect(self, position, device, bcd=None):
+        with self.lock:
+            board = self.boards[position]
+            assert board["devnum"] is None, position
+            vid, pid, serialno, interfaces = device
+            devnum = self._next_devnum()
+            self.tree.add(position, self.BUS, devnum, vid, pid, serialno, interfaces, bcd=bcd)
+            board["device"] = device
+            board["devnum"] = devnum
+        ms.UsbEventWaiter.notify()
+
+    def _disconnect(self, position):
+        with self.lock:
+            board = self.boards[position]
+            self.tree.remove(position)
+            self.devnums.discard(board["devnum"])
+            board["devnum"] = None
+        ms.UsbEventWaiter.notify()
+
+    def connected(self, position, devnum):
+        with self.lock:
+            board = self.boards.get(position)
+            return board is not None and board["devnum"] == devnum
+
+    def transport(self, device):
+        position = os.path.basename(device.syspaths[0])
+        if not self.connected(position, device.path.address):
+            raise IOError("%s is not a virtual board" % (device,))
+        failure = None
+        with self.lock:
+            for name in self.FAILURES:
+                if self.rand.random() < self.failures.get(name, 0):
+                    failure = name
+                    break
+            self.loads.append((position, failure))
+        return VirtualFx2Transport(self, position, device.path.address, failure)
+
+    def run(self, position, memory, failure=None):
+        """Start the 8051 on the board at position running the firmware in memory."""
+        descriptor = ms.firmware_descriptor([ms.IHexSegment(0, memory)])
+        with self.lock:
+            board = self.boards[position]
+            if failure == "wrong-state" or descriptor is None:
+                device, bcd = fake_board_device(board["type"], "unconfigured"), 0
+            else:
+                device, bcd = firmware_device(board["type"], descriptor), descriptor.bcd
+
+            self._disconnect(position)
+            if failure == "disconnect":
+                return
+            delay = max(0, self.delay + self.rand.uniform(-self.jitter, self.jitter))
+            timer = threading.Timer(delay, self._connect, (position, device, bcd))
+            timer.daemon = True
+            self.timers.append(timer)
+            timer.start()
+
+    def install(self):
+        """Make the USB scanning and transports use the virtual boards."""
+        assert ms.VIRTUAL_FX2 is None
+        self.saved = ms.SYS_ROOT, ms.DEV_ROOT, ms.FIRMWARE_STATE.filename
+        ms.SYS_ROOT, ms.DEV_ROOT = self.tree.sys_root, self.tree.dev_root
+        ms.FIRMWARE_STATE.filename = os.path.join(self.tree.root, "firmware-state.json")
+        ms.VIRTUAL_FX2 = self
+        ms.FIND_SYS_CACHE.clear()
+
+    def uninstall(self):
+        for timer in self.timers:
+            timer.cancel()
+        ms.SYS_ROOT, ms.DEV_ROOT, ms.FIRMWARE_STATE.filename = self.saved
+        ms.VIRTUAL_FX2 = None
+        ms.FIND_SYS_CACHE.clear()
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *args):
+        self.uninstall()
+
+
+def test_virtual_fx2():
+    import argparse
+    import shutil
+    import tempfile
+
+    args = argparse.Namespace(verbose=0, force=False, by_type=None, by_position=None, usb_backend="sysfs")
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with VirtualFx2Host(os.path.join(tmpdir, "ok"), delay=0.05, jitter=0.02) as host:
+            for board_type in ("opsis", "opsis", "opsis", "atlys"):
+                host.plug(board_type)
+            host.plug("atlys", "jtag")
+            boards = ms.find_hdmi2usb_boards(args)
+            assert [b.state for b in boards] == ["unconfigured"] * 4 + ["jtag"], boards
+
+            # The Atlys jtag firmware reports itself as an Opsis, so the
+            # Atlys boards come back as the wrong thing (without waiting
+            # for the timeout), even the one already in jtag mode.
+            results = ms.switch_boards_mode(args, boards, "jtag", jobs=5, timeout=5)
+            assert [r.status for r in results] == ["ok"] * 3 + ["wrong-state"] * 2, results
+            assert all(r.latency < 2 for r in results), results
+            assert ms.find_hdmi2usb_boards(args)[3].type == "opsis"
+            results = results[:3]
+            for r in results:
+                assert (r.new_board.position, r.new_board.type) == (r.board.position, r.board.type)
+                assert r.new_board.state == "jtag" and r.new_board.dev.path != r.board.dev.path
+            assert len(host.loads) == 5, host.loads
+
+            # Already running the jtag firmware, so nothing is loaded.
+            results = ms.switch_boards_mode(args, [r.new_board for r in results], "jtag", jobs=3, timeout=5)
+            assert [r.status for r in results] == ["ok"] * 3, results
+            assert len(host.loads) == 5, host.loads
+
+            opsis = [r.new_board for r in results if r.new_board.type == "opsis"]
+            results = ms.switch_boards_mode(args, opsis, "serial", jobs=3, timeout=5)
+            assert [r.status for r in results] == ["ok"] * 3, results
+            assert all(r.new_board.state == "serial" and r.new_board.tty() for r in results)
+
+        for failure, status in (("short-write", "error"), ("wrong-state", "wrong-state"), ("disconnect", "timeout")):
+            with VirtualFx2Host(os.path.join(tmpdir, failure), delay=0.05, failures={failure: 1.0}) as host:
+                host.plug("opsis", "jtag")
+                boards = ms.find_hdmi2usb_boards(args)
+                results = ms.switch_boards_mode(args, boards, "serial", timeout=0.5)
+                assert [r.status for r in results] == [status], (failure, results)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_inventory_daemon():
+    import argparse
+    import json
+    import shutil
+    import socket
+    import tempfile
+
+    args = argparse.Namespace(verbose=0, by_type=None, by_position=None, usb_backend="sysfs")
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with VirtualFx2Host(tmpdir) as host:
+            host.plug("opsis")
+            daemon = ms.InventoryDaemon(args, socket_path=os.path.join(tmpdir, "socket"))
+            daemon.rescan()
+            assert len(daemon.boards) == 1, daemon.boards
+            scantime = daemon.scantime
+
+            # A scan which falls over keeps the last inventory.
+            sys_root = ms.SYS_ROOT
+            ms.SYS_ROOT = os.path.join(tmpdir, "missing", "sys", "bus", "usb", "devices")
+            try:
+                daemon.rescan()
+            finally:
+                ms.SYS_ROOT = sys_root
+            assert len(daemon.boards) == 1 and daemon.scantime == scantime, daemon.boards
+
+            # A rescan request is answered from a new scan.
+            host.plug("opsis")
+            client, server = socket.socketpair()
+            client.sendall('{"rescan": true}\n')
+            daemon.serve_one(server)
+            response = json.loads(client.makefile("r").read())
+            client.close()
+            assert len(response["boards"]) == 2 and response["scantime"] > scantime, response
+
+        for request, error in (("[]\n", True), ("nonsense\n", True), ('"boards"\n', True),
+                               ('{"boards": true, "by_type": "opsis"}\n', False)):
+            client, server = socket.socketpair()
+            client.sendall(request)
+            daemon.serve_one(server)
+            response = json.loads(client.makefile("r").read())
+            client.close()
+            assert ("error" in response) == error, (request, response)
+            assert error or len(response["boards"]) == 2, response
+
+        # Daemons which don't answer (or answer rubbish) are the same as no
+        # daemon, so the caller scans for itself.
+        socket_path = os.path.join(tmpdir, "busy")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(socket_path)
+        listener.listen(1)
+        try:
+            assert ms.query_daemon({"boards": True}, socket_path, timeout=0.1) is None
+            listener.accept()[0].close()
+            for answer in ('{"boards": [', '[]'):
+                answered = threading.Thread(target=lambda: listener.accept()[0].sendall(answer))
+                answered.start()
+                assert ms.query_daemon({"boards": True}, socket_path, timeout=1.0) is None, answer
+                answered.join()
+            assert ms.query_daemon({"boards": True}, os.path.join(tmpdir, "missing"), timeout=0.1) is None
+            # A running daemon's socket isn't taken over, even if it's busy.
+            try:
+                ms.InventoryDaemon(args, socket_path=socket_path).listen()
+            except SystemError:
+                pass
+            else:
+                assert False, "listened on a running daemon's socket"
+        finally:
+            listener.close()
+        os.unlink(socket_path)
+        daemon = ms.InventoryDaemon(args, socket_path=socket_path)
+        daemon.listen().close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def run_tests(names=None, output=sys.stdout):
+    """Run the test_* functions in this module (or just those in names).
+
+    Returns the names of the tests which failed.
+    """
+    import traceback
+
+    tests = sorted(name for name in globals() if name.startswith("test_"))
+    for name in names or []:
+        if name not in tests:
+            raise SystemError("No test called %s, the tests are: %s" % (name, ", ".join(tests)))
+    failed = []
+    for name in names or tests:
+        starttime = time.time()
+        try:
+            globals()[name]()
+            status = "ok"
+        except Exception:
+            traceback.print_exc()
+            failed.append(name)
+            status = "FAILED"
+        output.write("%-30s %-6s %7.2fs\n" % (name, status, time.time() - starttime))
+        output.flush()
+    output.write("%i of %i tests failed\n" % (len(failed), len(names or tests)))
+    return failed
+
+
+def benchmark(func, iterations, setup=None):
+    """Run func iterations times, returning the times taken in seconds."""
+    timings = []
+    for i in range(iterations):
+        if setup:
+            setup()
+        starttime = time.time()
+        func()
+        timings.append(time.time() - starttime)
+    return timings
+
+
+def run_benchmarks(args, sizes, iterations, replay=False):
+    """Time the enumeration, mapping and classification on fake trees.
+
+    If replay is set the tree currently in SYS_ROOT (a replayed capture) is
+    benchmarked too. Returns a list of dictionaries (one per benchmark and
+    tree).
+    """
+    import argparse
+    import shutil
+    import tempfile
+
+    scan_args = argparse.Namespace(**vars(args))
+    scan_args.by_type = None
+    scan_args.verbose = 0
+
+    trees = [lambda tmpdir, size=size: create_fake_usb_tree(tmpdir, devices=size) for size in sizes]
+    if replay:
+        trees.append(lambda tmpdir, roots=(ms.SYS_ROOT, ms.DEV_ROOT): roots)
+
+    results = []
+    old_roots = ms.SYS_ROOT, ms.DEV_ROOT
+    for make_tree in trees:
+        tmpdir = tempfile.mkdtemp(prefix="hdmi2usb-bench-")
+        try:
+            ms.SYS_ROOT, ms.DEV_ROOT = make_tree(tmpdir)
+            ms.FIND_SYS_CACHE.clear()
+
+            devices = ms.find_usb_devices_sysfs()
+            boards = ms.find_hdmi2usb_boards(scan_args)
+            mapping = ms.create_sys_mapping()
+
+            def find_sys_all():
+                for device in devices:
+                    ms.find_sys(device.path, mapping)
+
+            def classify_all():
+                for device in devices:
+                    ms.BOARD_REGISTRY.classify(device)
+
+            def drivers_and_tty():
+                for board in boards:
+                    board.dev.refresh()
+                    board.dev.drivers()
+                    board.tty()
+
+            tests = [
+                ("create_sys_mapping", ms.create_sys_mapping, None),
+                ("find_sys", find_sys_all, None),
+                ("enumerate_cold", ms.find_usb_devices_sysfs, ms.FIND_SYS_CACHE.clear),
+                ("enumerate_warm", ms.find_usb_devices_sysfs, None),
+                ("classify", classify_all, None),
+                ("find_hdmi2usb_boards", lambda: ms.find_hdmi2usb_boards(scan_args), None),
+                ("drivers_and_tty", drivers_and_tty, None),
+                ]
+            for name, func, setup in tests:
+                timings = list(sorted(benchmark(func, iterations, setup)))
+                results.append({
+                    "name": name,
+                    "devices": len(devices),
+                    "interfaces": sum(len(d.syspaths) - 1 for d in devices),
+                    "boards": len(boards),
+                    "iterations": iterations,
+                    "min": timings[0],
+                    "median": timings[len(timings) // 2],
+                    })
+        finally:
+            ms.SYS_ROOT, ms.DEV_ROOT = old_roots
+            ms.FIND_SYS_CACHE.clear()
+            shutil.rmtree(tmpdir)
+    return results
+
+
+def run_switch_benchmarks(args, sizes, iterations, delay=0.5, failures=None, timeout=10.0):
+    """Time mode switches, end to end, on VirtualFx2Host boards.
+
+    For each size that many Opsis boards are switched back and forth
+    between jtag and serial mode, all at once. Returns a list of
+    dictionaries like run_benchmarks does, timing how long each board took
+    to switch, with the number of each kind of failure too.
+    """
+    import argparse
+    import shutil
+    import tempfile
+
+    switch_args = argparse.Namespace(**vars(args))
+    switch_args.by_type = None
+    switch_args.by_position = None
+    switch_args.by_device = None
+    switch_args.usb_backend = "sysfs"
+    switch_args.force = False
+    switch_args.verbose = 0
+
+    results = []
+    for size in sizes:
+        tmpdir = tempfile.mkdtemp(prefix="hdmi2usb-bench-")
+        try:
+            with VirtualFx2Host(tmpdir, delay=delay, failures=failures) as host:
+                for i in range(size):
+                    host.plug("opsis")
+                devices = ms.find_usb_devices_sysfs()
+
+                switches = {}
+                for i in range(iterations * 2):
+                    mode = ["jtag", "serial"][i % 2]
+                    # Boards which failed last time are found again in whatever state they are in.
+                    boards = ms.find_hdmi2usb_boards(switch_args)
+                    switches.setdefault(mode, []).extend(
+                        ms.switch_boards_mode(switch_args, boards, mode, jobs=len(boards), timeout=timeout))
+
+                for mode, switched in sorted(switches.items()):
+                    timings = list(sorted(r.latency for r in switched if r.status == "ok")) or [float("nan")]
+                    failed = {}
+                    for r in switched:
+                        if r.status != "ok":
+                            failed[r.status] = failed.get(r.status, 0) + 1
+                    results.append({
+                        "name": "switch_%s" % mode,
+                        "devices": len(devices),
+                        "interfaces": sum(len(d.syspaths) - 1 for d in devices),
+                        "boards": size,
+                        "iterations": iterations,
+                        "min": timings[0],
+                        "median": timings[len(timings) // 2],
+                        "failed": failed,
+                        })
+        finally:
+            shutil.rmtree(tmpdir)
+    return results
+
+
+def print_benchmarks(results, baseline=None, output=sys.stdout):
+    """Print results as a table, comparing against baseline results."""
+    old = {}
+    for result in baseline or []:
+        old[(result["name"], result["devices"])] = result
+
+    output.write("%-22s %7s %7s %6s %10s %11s %8s\n" % (
+        "benchmark", "devices", "ifaces", "boards", "min (ms)", "median (ms)", "change"))
+    for result in results:
+        change = ""
+        previous = old.get((result["name"], result["devices"]))
+        if previous and previous["median"]:
+            change = "%+.1f%%" % ((result["median"] / previous["median"] - 1) * 100)
+        output.write("%-22s %7i %7i %6i %10.3f %11.3f %8s\n" % (
+            result["name"], result["devices"], result["interfaces"], result["boards"],
+            result["min"] * 1000, result["median"] * 1000, change))
+        if result.get("failed"):
+            output.write("%-22s %s\n" % ("", ", ".join(
+                "%s %s" % (count, status) for status, count in sorted(result["failed"].items()))))
+
+
+def test_capture_replay():
+    import shutil
+    import tempfile
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        host = os.path.join(tmpdir, "host")
+        sys_root, _ = create_fake_usb_tree(host, devices=50)
+        archive = os.path.join(tmpdir, "capture.tar.gz")
+        ms.capture_usb_host(archive, root=host, lsusb=False)
+
+        replayed_root, _, lsusb = ms.replay_usb_host(archive, os.path.join(tmpdir, "replay"))
+        assert lsusb is None
+        original = sorted(ms.find_usb_devices_sysfs(sys_root=sys_root))
+        replayed = sorted(ms.find_usb_devices_sysfs(sys_root=replayed_root))
+        assert original and len(original) == len(replayed), (len(original), len(replayed))
+        original_nodes = ms.DeviceNodeIndex(host)
+        replayed_nodes = ms.DeviceNodeIndex(ms.host_root(replayed_root))
+        for a, b in zip(original, replayed):
+            assert a == b, (a, b)
+            assert [os.path.basename(p) for p in a.syspaths] == [os.path.basename(p) for p in b.syspaths]
+            assert a.drivers() == b.drivers(), (a.drivers(), b.drivers())
+            position = os.path.basename(a.syspaths[0])
+            assert original_nodes.ttys(position) == replayed_nodes.ttys(position)
+            assert original_nodes.videos(position) == replayed_nodes.videos(position)
+        assert original_nodes.by_node and original_nodes.by_node == replayed_nodes.by_node
+
+        # Archives which would write (or point) outside where they are unpacked.
+        import tarfile
+        import StringIO
+        evil = [
+            [("x", "."), ("e", "x/.."), ("e/escaped.txt", None)],
+            [("x", "."), ("e", "x/..")],
+            [("e", "../outside")],
+            [("../escaped.txt", None)],
+            ]
+        for n, members in enumerate(evil):
+            archive = os.path.join(tmpdir, "evil%i.tar" % n)
+            with tarfile.open(archive, "w") as tar:
+                for name, linkname in members:
+                    info = tarfile.TarInfo(name)
+                    if linkname is None:
+                        info.size = 4
+                        tar.addfile(info, StringIO.StringIO("evil"))
+                    else:
+                        info.type = tarfile.SYMTYPE
+                        info.linkname = linkname
+                        tar.addfile(info)
+            unpack = os.path.join(tmpdir, "evil%i" % n, "root")
+            os.makedirs(unpack)
+            try:
+                ms.replay_usb_host(archive, unpack)
+                assert False, "%s was unpacked" % (members,)
+            except SystemError:
+                pass
+            assert not os.path.exists(os.path.join(tmpdir, "evil%i" % n, "escaped.txt")), members
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_device_nodes():
+    import shutil
+    import tempfile
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        tree = FakeUsbTree(tmpdir)
+        tree.add("usb1", 1, 1, "1d6b", "0002", None, [("hub", None)])
+        opsis = [("uvcvideo", "video"), ("uvcvideo", None), ("cdc_acm", "ttyACM"), ("cdc_acm", None)]
+        for n in range(11):
+            tree.add("1-%i" % (n+1), 1, n+2, "2a19", "5442", "%010i" % n, opsis)
+        tree.add("1-12", 1, 13, "16c0", "06ad", "hw_nexys", [(None, None), ("ftdi_sio", "ttyUSB")])
+        tree.add("1-13", 1, 14, "04e2", "1410", None, [("cdc_acm", "ttyACM")])
+
+        nodes = ms.DeviceNodeIndex(tmpdir)
+        assert nodes.videos("1-1") == ["/dev/video0"], nodes.videos("1-1")
+        assert nodes.ttys("1-11") == ["/dev/ttyACM10"], nodes.ttys("1-11")
+        assert nodes.position("/dev/video10") == "1-11"
+        assert nodes.position("/dev/ttyUSB0") == "1-12"
+        assert nodes.position("/dev/ttyS0") is None
+
+        nodes.attach("1-12", "1-13", first=True)
+        assert nodes.ttys("1-12") == ["/dev/ttyACM11", "/dev/ttyUSB0"], nodes.ttys("1-12")
+        assert nodes.position("/dev/ttyACM11") == "1-12"
+
+        tree.remove("1-13")
+        nodes.scan()
+        assert nodes.ttys("1-12") == ["/dev/ttyUSB0"], nodes.ttys("1-12")
+        assert nodes.position("/dev/ttyACM11") is None
+    finally:
+        shutil.rmtree(tmpdir)